@@ -0,0 +1,145 @@
+"""
+Headless sky charts for PyPlanetarium
+
+Renders many charts (cities x dates x zooms) to PNG without opening a
+window: SDL's dummy video driver stands in for the display, and each chart is
+drawn by Planetarium's own star computation and drawStars, so it looks just
+like the main screen without the buttons.
+
+Jobs are spread over a process pool.  Every worker builds one Planetarium,
+and with it the memory-mapped catalog, when it starts and keeps it for all
+of its jobs.  Jobs are handed out in (city, date) order, so charts of the
+same sky at different zooms or viewports mostly land on the same worker and
+reuse its computed positions.
+
+    $ python batch.py jobs.csv charts/ [--processes 4] [--size 1000x666]
+
+jobs.csv has one chart per row: city,date,zoom[,left,up] with the date as
+"YYYY-mm-dd HH:MM", zoom as Planetarium's shift (500 to 10000) and left,up
+the top left corner of the view on the "big" screen (the middle of the sky
+when left out).  Lines starting with # are skipped.
+"""
+from __future__ import division
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy") #before pygame is imported
+
+import argparse
+import csv
+import datetime
+import multiprocessing
+import pygame
+from catalog import loadCatalog
+from planetarium import Planetarium, CATALOG_SOURCES
+
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+CHUNK_SIZE = 8 #jobs handed to a worker at a time
+
+
+class ChartRenderer(object):
+    #one headless Planetarium, reused for every chart this process draws
+    def __init__(self, width=1000, height=666, catalogs=()):
+        self.app = Planetarium(width, height, catalogs=catalogs)
+        self.app.mode = "main"
+        #no display to match, so say what kind of surface; PNGs want 32 bit
+        self.surface = pygame.Surface((width, height), 0, 32)
+
+    def render(self, job, path):
+        #job = (city, date, zoom, viewport); viewport is (left, up) or None
+        (city, date, zoom, viewport) = job
+        app = self.app
+        app.setCity(city)
+        app.date = date
+        app.shift = max(app.minZoom, min(app.maxZoom, zoom))
+        if viewport == None:
+            viewport = (app.shift-app.width//2, app.shift-app.height//2)
+        app.screenPos = viewport
+        app.skyCache.invalidate()
+        app.calculateStars()
+        self.surface.fill(app.bgColor)
+        app.drawStars(self.surface)
+        pygame.image.save(self.surface, path)
+        return path
+
+
+#each pool process keeps its own renderer here
+renderer = None
+
+def startWorker(width, height, catalogs):
+    global renderer
+    renderer = ChartRenderer(width, height, catalogs)
+
+def renderJob(task):
+    (job, path) = task
+    return renderer.render(job, path)
+
+def chartPath(folder, number, job):
+    (city, date, zoom, viewport) = job
+    name = "%05d-%s-%s-%d.png" % (number, city.replace(" ", "_"),
+                                  date.strftime("%Y%m%d-%H%M"), zoom)
+    return os.path.join(folder, name)
+
+def renderCharts(jobs, folder, processes=None, width=1000, height=666,
+                 catalogs=()):
+    #renders every job to folder; returns the paths in the order of jobs.
+    #processes=1 draws them all in this process.
+    if not os.path.isdir(folder): os.makedirs(folder)
+    tasks = [(job, chartPath(folder, number, job))
+             for (number, job) in enumerate(jobs)]
+    #same sky next to each other, so chunks share computed positions
+    ordered = sorted(tasks, key=lambda task: (task[0][0], task[0][1]))
+    #compiled once up front, not by every worker at the same time
+    loadCatalog(CATALOG_SOURCES + list(catalogs))
+    if processes == 1:
+        startWorker(width, height, catalogs)
+        for task in ordered: renderJob(task)
+    else:
+        pool = multiprocessing.Pool(processes, startWorker,
+                                    (width, height, list(catalogs)))
+        try:
+            for path in pool.imap_unordered(renderJob, ordered, CHUNK_SIZE):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    return [path for (job, path) in tasks]
+
+def readJobs(path):
+    #jobs from a csv file laid out as described at the top of this file;
+    #raises ValueError naming the line of a row that isn't 3 or 5 fields
+    jobs = [ ]
+    with open(path, "rt") as fin:
+        reader = csv.reader(fin)
+        for row in reader:
+            if len(row) == 0 or row[0].lstrip().startswith("#"): continue
+            if len(row) not in (3, 5):
+                raise ValueError("%s line %d: expected city,date,zoom"
+                                 "[,left,up] but got %d fields" %
+                                 (path, reader.line_num, len(row)))
+            row = [field.strip() for field in row]
+            date = datetime.datetime.strptime(row[1], DATE_FORMAT)
+            viewport = None
+            if len(row) == 5: viewport = (int(row[3]), int(row[4]))
+            jobs.append((row[0], date, int(row[2]), viewport))
+    return jobs
+
+def main():
+    parser = argparse.ArgumentParser(description="Render sky charts to PNG")
+    parser.add_argument("jobs", help="csv of city,date,zoom[,left,up]")
+    parser.add_argument("folder", help="where the charts go")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--size", default="1000x666", help="WIDTHxHEIGHT")
+    parser.add_argument("catalogs", nargs="*",
+                        help="extra .edb/.csv catalogs, as for planetarium.py")
+    args = parser.parse_args()
+    (width, height) = [int(value) for value in args.size.split("x")]
+    try:
+        jobs = readJobs(args.jobs)
+    except ValueError as error:
+        parser.error(str(error))
+    paths = renderCharts(jobs, args.folder, args.processes, width, height,
+                         args.catalogs)
+    print "Rendered %d charts to %s" % (len(paths), args.folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+from __future__ import division
+
+"""
+Star catalog storage for PyPlanetarium
+
+A Catalog keeps one column per field (names, RA, Dec, magnitude, and from
+SkyEngine alt, az, screen x/y and radius) instead of one Python object per
+star.  Star is a two-slot view into a row, so code that works with single
+stars (Line, the quiz, save files) can still pass them around.
+
+Parsing .edb/.csv text and building ephem bodies is slow, so catalogs are
+streamed once into a binary file (see compileCatalog for the layout) that is
+memory mapped at startup.  The file records a checksum of its sources and is
+rebuilt automatically when they change.  Rows are sorted by magnitude, so a
+large catalog can be cut down to its bright tiers without copying anything.
+"""
+import csv
+import math
+import mmap
+import os
+import struct
+import zlib
+import numpy
+import ephem
+import ephem.stars
+from sky import SkyEngine, SkyState, J2000
+
+BUILTIN = "<ephem.stars>" #stands for PyEphem's built-in star list
+SKIP = set(["Benetnasch"]) #duplicate of Alkaid
+#names one star goes by; Catalog.find() treats them all as the same star
+ALIASES = (("Alkaid", "Alcaid", "Benetnasch"),)
+MAGIC = b"PYPCAT"
+VERSION = 2
+#magic, version, star count, source checksum, payload checksum, name bytes
+HEADER = struct.Struct("<6sHIIII")
+HEADER_SIZE = 32 #header padded so the arrays start 8-byte aligned
+COLUMNS = ("ra", "dec", "mag", "pmRA", "pmDec", "epoch")
+#header names accepted for each field of a .csv catalog
+CSV_FIELDS = (("name", ("name", "proper", "hip", "tyc", "id")),
+              ("ra", ("ra", "radeg", "ra_deg", "raicrs")),
+              ("dec", ("dec", "dedeg", "dec_deg", "deicrs")),
+              ("mag", ("mag", "vmag", "hpmag", "vtmag")),
+              ("pmRA", ("pmra",)),
+              ("pmDec", ("pmdec", "pmde")),
+              ("epoch", ("epoch",)))
+CHUNK_SIZE = 65536 #stars parsed at a time
+NAME_STEP = 4096 #rows the name index first grows by
+CHECK_BYTES = 1 << 20 #compiled file checksummed this much at a time
+#faint limits of the magnitude tiers; only the tiers a zoom level can show
+#are put through the engine
+TIERS = (2.0, 4.0, 6.0, 8.0, 9.0, 10.0, 11.0, 12.0)
+
+
+class Star(object):
+    __slots__ = ("catalog", "index")
+
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index = index
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "Star(%r)" % self.name
+
+    def __eq__(self, other):
+        #rows for the same star (the same name in two sources, or aliases)
+        #are equal
+        if not isinstance(other, Star): return False
+        if other.catalog is not self.catalog: return self.name == other.name
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    @property
+    def key(self):
+        return self.catalog.canonical(self.index)
+
+    @property
+    def name(self):
+        return self.catalog.names[self.index]
+
+    @property
+    def body(self):
+        return self.catalog.body(self.index)
+
+    def details(self, observer):
+        return self.catalog.details(self.index, observer)
+
+    @property
+    def r(self):
+        return int(self.catalog.r[self.index])
+
+    @property
+    def screenPos(self):
+        #position on the "big" screen, None if below the horizon
+        return self.catalog.screenPos(self.index)
+
+    def displayPos(self, left, up):
+        if self.screenPos == None: return None
+        (x,y) = self.screenPos
+        return (int(x - left), int(y - up))
+
+
+class Catalog(SkyEngine):
+    def __init__(self, names, ra, dec, mag, pmRA=None, pmDec=None,
+                                                            epoch=J2000):
+        super(Catalog, self).__init__(ra, dec, mag, pmRA, pmDec, epoch)
+        if not isinstance(names, NameTable): names = list(names)
+        self.names = names
+        #compiled catalogs are sorted by magnitude, which makes each tier a
+        #prefix of the arrays
+        mag = self.mag
+        self.sorted = bool(numpy.all(mag[1:] >= mag[:-1]))
+        self.tierEnds = numpy.searchsorted(mag, TIERS, side="right")
+        #lower case name -> first row with it, for the first indexedRows
+        #rows; grown a tier at a time as lookups need it (see indexNames)
+        self.nameIndex = { }
+        self.indexedRows = 0
+        self.checksum = None #of the names in row order, see rowChecksum
+        #ephem bodies are only built for stars someone looks at
+        self.bodies = { }
+        self.bodyStates = { }
+
+    @staticmethod
+    def fromBodies(bodies):
+        engine = SkyEngine.fromBodies(bodies)
+        return Catalog([body.name for body in bodies], engine.ra, engine.dec,
+                       engine.mag, engine.pmRA, engine.pmDec, engine.epoch)
+
+    def __getitem__(self, index):
+        return Star(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Star(self, index)
+
+    def indexNames(self, end):
+        #indexes rows up to end; each name keeps the first (brightest, once
+        #compiled) row it was seen on, and every alias of a star maps to the
+        #same row
+        start = self.indexedRows
+        if end <= start: return
+        if isinstance(self.names, NameTable):
+            #split out of the mapped text in one go, not a row at a time
+            text = self.names.text(start, end)
+            if not isinstance(text, str): text = text.decode("utf-8")
+            names = text.lower().split("\n")
+        else:
+            names = [name.lower() for name in self.names[start:end]]
+        #a dict built from the rows backwards keeps each name's first row
+        added = dict(zip(reversed(names), range(end-1, start-1, -1)))
+        if len(added) < len(self.nameIndex):
+            for name in [name for name in added if name in self.nameIndex]:
+                del added[name]
+            self.nameIndex.update(added)
+        else:
+            added.update(self.nameIndex)
+            self.nameIndex = added
+        self.indexedRows = end
+        for group in ALIASES:
+            rows = [self.nameIndex[name.lower()] for name in group
+                                            if name.lower() in self.nameIndex]
+            if len(rows) == 0: continue
+            for name in group:
+                self.nameIndex[name.lower()] = min(rows)
+
+    def find(self, name, rows=None):
+        #the Star called name (any case, or an alias) among the first rows
+        #(all by default), None if there's none.  Rows are indexed only as
+        #far as it takes, so bright stars are found without indexing a big
+        #catalog's faint tail.
+        if rows == None: rows = len(self)
+        name = name.strip().lower()
+        while True:
+            index = self.nameIndex.get(name)
+            if index != None and index < rows: return Star(self, index)
+            if self.indexedRows >= rows: return None
+            self.indexNames(min(rows, max(NAME_STEP, 4*self.indexedRows)))
+
+    def rowsThrough(self, magnitude):
+        #how many rows it takes to hold every star down to magnitude
+        if not self.sorted: return len(self)
+        return int(numpy.searchsorted(self.mag, magnitude, side="right"))
+
+    def rowChecksum(self):
+        #crc32 of the names in row order: two catalogs with the same one
+        #agree on which star every row is, so saved drawings can use rows
+        if self.checksum == None:
+            if isinstance(self.names, NameTable): text = self.names.text()
+            else:
+                text = "\n".join(self.names)
+                if not isinstance(text, bytes): text = text.encode("utf-8")
+            self.checksum = zlib.crc32(text) & 0xffffffff
+        return self.checksum
+
+    def canonical(self, index):
+        #the row find() gives for this row's name; that is never a later row,
+        #so the rows up to this one are all that need indexing
+        self.indexNames(index+1)
+        return self.nameIndex[self.names[index].lower()]
+
+    def body(self, index):
+        #the ephem body for one row, for details like a_ra and constellation;
+        #built on first use and kept
+        body = self.bodies.get(index)
+        if body == None:
+            (ra, dec) = (self.ra[index], self.dec[index])
+            year = dateToYear(self.epoch[index])
+            #.edb has no quoting, so a name with a comma in it (fine in a
+            #.csv) would break the line; the name is set on the body instead.
+            #FixedBody alone has no way to take the magnitude.
+            line = "star,f,%.10f|%r,%.10f|%r,%r,%.6f" % (
+                        math.degrees(ra)/15, float(self.pmRA[index]),
+                        math.degrees(dec), float(self.pmDec[index]),
+                        float(self.mag[index]), year)
+            body = self.bodies[index] = ephem.readdb(line)
+            body.name = self.names[index]
+        return body
+
+    def details(self, index, observer):
+        #the body computed for observer, only recomputed when the observer's
+        #date or location has changed since the last call
+        body = self.body(index)
+        state = SkyState(observer)
+        if self.bodyStates.get(index) != state:
+            body.compute(observer)
+            self.bodyStates[index] = state
+        return body
+
+    def releaseBodies(self):
+        self.bodies.clear()
+        self.bodyStates.clear()
+
+    def setLimit(self, magnitude):
+        #computes only the tiers needed to show stars down to magnitude
+        #(everything if the catalog isn't sorted) and shows only the stars
+        #within it; True if either changed
+        count = len(self)
+        tier = int(numpy.searchsorted(TIERS, magnitude))
+        if self.sorted and tier < len(TIERS):
+            count = int(self.tierEnds[tier])
+        changed = self.setActive(count)
+        return self.setMagnitudeLimit(magnitude) or changed
+
+    def screenPos(self, index):
+        if self.visible is None or self.shift is None: return None
+        if index >= len(self.visible) or not self.visible[index]: return None
+        (x, y) = self.screenPoints(index)
+        return (float(x), float(y))
+
+
+############################# PARSING ########################################
+
+
+def yearToDate(year):
+    #decimal year -> ephem.Date, the way .edb epochs are read
+    whole = int(math.floor(year))
+    start = float(ephem.Date("%d/1/1" % whole))
+    end = float(ephem.Date("%d/1/1" % (whole+1)))
+    return start + (year-whole)*(end-start)
+
+def dateToYear(date):
+    year = ephem.Date(date).triple()[0]
+    start = yearToDate(year)
+    return year + (date - start)/(yearToDate(year+1) - start)
+
+def parseAngle(text):
+    #"h:m:s", "d:m:s" or a plain decimal, with an optional leading sign
+    text = text.strip()
+    sign = -1 if text.startswith("-") else 1
+    parts = [float(part) for part in text.lstrip("+-").split(":")]
+    value = 0
+    for (i, part) in enumerate(parts):
+        value += part/60**i
+    return sign*value
+
+def parseMotion(field):
+    #"value|proper motion", proper motion in mas/year
+    if "|" in field:
+        (value, motion) = field.split("|")[:2]
+        return (parseAngle(value), float(motion))
+    return (parseAngle(field), 0.0)
+
+def parseEdbLine(line):
+    #returns (name, ra, dec, mag, pmRA, pmDec, epoch) for a fixed object,
+    #None for comments and other kinds of object
+    line = line.strip()
+    if line == "" or line.startswith("#"): return None
+    fields = line.split(",")
+    if len(fields) < 5 or not fields[1].startswith("f"): return None
+    (ra, pmRA) = parseMotion(fields[2])
+    (dec, pmDec) = parseMotion(fields[3])
+    mag = float(fields[4])
+    epoch = J2000
+    if len(fields) > 5 and fields[5].strip() != "":
+        epoch = yearToDate(float(fields[5]))
+    return (fields[0].strip(), math.radians(ra*15), math.radians(dec),
+            mag, pmRA, pmDec, epoch)
+
+def csvColumns(header):
+    #header row -> {field: column number}; ra and dec are in degrees,
+    #proper motion in mas/year (pmRA already times cos dec, as Hipparcos
+    #and Tycho give it), epoch a decimal year
+    header = [column.strip().lower() for column in header]
+    columns = { }
+    for (field, aliases) in CSV_FIELDS:
+        for alias in aliases:
+            if alias in header:
+                columns[field] = header.index(alias)
+                break
+    for field in ("ra", "dec", "mag"):
+        if field not in columns:
+            raise ValueError("catalog has no %s column" % field)
+    return columns
+
+def parseCsvRow(row, columns, number):
+    #same record as parseEdbLine; None for rows missing a position or
+    #magnitude.  Unnamed stars are called "#<row number>".
+    def field(name, default=None):
+        if name not in columns or columns[name] >= len(row): return default
+        value = row[columns[name]].strip()
+        return default if value == "" else value
+    (ra, dec, mag) = (field("ra"), field("dec"), field("mag"))
+    if ra == None or dec == None or mag == None: return None
+    epoch = field("epoch")
+    epoch = J2000 if epoch == None else yearToDate(float(epoch))
+    return (field("name", "#%d" % number), math.radians(float(ra)),
+            math.radians(float(dec)), float(mag), float(field("pmRA", 0)),
+            float(field("pmDec", 0)), epoch)
+
+def readRecords(source):
+    #yields one record per star, reading files a line at a time
+    if source == BUILTIN:
+        for line in ephem.stars.db.splitlines():
+            record = parseEdbLine(line)
+            if record != None: yield record
+    elif source.lower().endswith(".csv"):
+        with open(source, "rt") as fin:
+            reader = csv.reader(fin)
+            columns = csvColumns(next(reader))
+            for (number, row) in enumerate(reader):
+                try:
+                    record = parseCsvRow(row, columns, number+1)
+                except ValueError: #unreadable row
+                    continue
+                if record != None: yield record
+    else:
+        with open(source, "rt") as fin:
+            for line in fin:
+                record = parseEdbLine(line)
+                if record != None: yield record
+
+def readChunks(sources, chunkSize=CHUNK_SIZE):
+    #yields (names, rows) with rows a numpy array of up to chunkSize stars,
+    #one column per field in COLUMNS
+    (names, rows) = ([ ], [ ])
+    for source in sources:
+        for record in readRecords(source):
+            if record[0] in SKIP: continue
+            names.append(record[0])
+            rows.append(record[1:])
+            if len(rows) == chunkSize:
+                yield (names, numpy.array(rows, dtype=float))
+                (names, rows) = ([ ], [ ])
+    if len(rows) > 0:
+        yield (names, numpy.array(rows, dtype=float))
+
+def parseSources(sources):
+    #names and one array per column, brightest star first; stars of equal
+    #magnitude keep the order of the sources
+    (names, chunks) = ([ ], [ ])
+    for (chunkNames, rows) in readChunks(sources):
+        names.extend(chunkNames)
+        chunks.append(rows)
+    if len(chunks) == 0: return ([ ], [numpy.zeros(0) for column in COLUMNS])
+    rows = numpy.concatenate(chunks)
+    order = numpy.argsort(rows[:, COLUMNS.index("mag")], kind="mergesort")
+    names = [names[i] for i in order.tolist()]
+    rows = rows[order]
+    return (names, [rows[:, i] for i in range(len(COLUMNS))])
+
+
+############################# COMPILED CATALOGS ##############################
+
+
+class NameTable(object):
+    #star names kept as one newline-joined block of utf-8 (straight from the
+    #memory map) and only turned into strings when asked for
+    def __init__(self, data, offset, size):
+        self.data = data
+        text = numpy.frombuffer(data, dtype=numpy.uint8, count=size,
+                                                            offset=offset)
+        ends = numpy.flatnonzero(text == ord("\n")) + offset
+        self.starts = numpy.concatenate(([offset], ends+1))
+        self.ends = numpy.concatenate((ends, [offset+size]))
+        if size == 0: self.starts = self.ends = numpy.zeros(0, dtype=int)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        name = self.data[int(self.starts[index]):int(self.ends[index])]
+        if not isinstance(name, str): name = name.decode("utf-8") #Python 3
+        return name
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text(self, start=0, end=None):
+        #names start to end (every name by default), newline-joined, as the
+        #raw bytes
+        if end == None: end = len(self)
+        if end <= start: return b""
+        return self.data[int(self.starts[start]):int(self.ends[end-1])]
+
+
+def sourceChecksum(sources):
+    #the built-in list by its text, files by their size and modification
+    #time so large catalogs needn't be read just to see that nothing changed
+    checksum = zlib.crc32(str(VERSION).encode("utf-8"))
+    for source in sources:
+        if source == BUILTIN:
+            stamp = ephem.stars.db
+        else:
+            info = os.stat(source)
+            stamp = "%d %r" % (info.st_size, info.st_mtime)
+        for text in (source, stamp):
+            if not isinstance(text, bytes): text = text.encode("utf-8")
+            checksum = zlib.crc32(text, checksum)
+    return checksum & 0xffffffff
+
+def compiledPath(sources):
+    #ybs.edb -> ybs.cat, next to the last file in sources
+    files = [source for source in sources if source != BUILTIN]
+    if len(files) == 0: return "stars.cat"
+    return os.path.splitext(files[-1])[0] + ".cat"
+
+def compileCatalog(sources, path):
+    #layout: HEADER (padded to HEADER_SIZE bytes), then one little-endian
+    #float64 array per column in COLUMNS order, then the names as utf-8
+    #joined by newlines.  Rows are sorted by magnitude so every tier is a
+    #prefix of the arrays.
+    (names, columns) = parseSources(sources)
+    nameText = "\n".join(names)
+    if not isinstance(nameText, bytes): nameText = nameText.encode("utf-8")
+    checksum = 0
+    for column in columns:
+        checksum = zlib.crc32(numpy.asarray(column, dtype="<f8").tobytes(),
+                                                                    checksum)
+    checksum = zlib.crc32(nameText, checksum)
+    header = HEADER.pack(MAGIC, VERSION, len(names), sourceChecksum(sources),
+                        checksum & 0xffffffff, len(nameText))
+    #written beside it and renamed over it, so another process that has the
+    #old file mapped keeps reading the old file rather than a changing one
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temp, "wb") as fout:
+            fout.write(header.ljust(HEADER_SIZE, b"\0"))
+            for column in columns:
+                fout.write(numpy.asarray(column, dtype="<f8").tobytes())
+            fout.write(nameText)
+        try:
+            os.rename(temp, path)
+        except OSError: #Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(temp, path)
+    finally:
+        if os.path.exists(temp): os.remove(temp)
+
+def readCompiled(path, checksum=None):
+    #memory maps a compiled catalog; raises ValueError if it is damaged,
+    #from another version, or (given checksum) built from other sources
+    with open(path, "rb") as fin:
+        data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (count, nameBytes) = checkCompiled(data, checksum)
+    except ValueError:
+        #unmapped now, not whenever the traceback goes, so the file can be
+        #replaced (Windows won't rename over or remove a mapped file)
+        data.close()
+        raise
+    size = len(data)
+    columns = [ ]
+    for i in range(len(COLUMNS)):
+        columns.append(numpy.frombuffer(data, dtype="<f8", count=count,
+                                        offset=HEADER_SIZE + 8*count*i))
+    names = NameTable(data, size-nameBytes, nameBytes)
+    return Catalog(names, *columns)
+
+def checkCompiled(data, checksum=None):
+    #(stars, name bytes) of a mapped compiled catalog; ValueError as for
+    #readCompiled
+    if len(data) < HEADER_SIZE: raise ValueError("not a compiled catalog")
+    (magic, version, count, sources, payloadChecksum,
+                        nameBytes) = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a version %d catalog" % VERSION)
+    if checksum != None and sources != checksum:
+        raise ValueError("catalog sources have changed")
+    size = HEADER_SIZE + 8*len(COLUMNS)*count + nameBytes
+    if len(data) != size or payloadCrc(data) != payloadChecksum:
+        raise ValueError("catalog is damaged")
+    return (count, nameBytes)
+
+def payloadCrc(data):
+    #crc32 of everything after the header, a slice at a time so the whole
+    #mapped file is never copied out at once
+    checksum = 0
+    for start in range(HEADER_SIZE, len(data), CHECK_BYTES):
+        checksum = zlib.crc32(data[start:start+CHECK_BYTES], checksum)
+    return checksum & 0xffffffff
+
+def loadCatalog(sources, path=None):
+    #sources: .edb or .csv paths and/or BUILTIN; path: where the compiled
+    #copy lives
+    if path == None: path = compiledPath(sources)
+    checksum = sourceChecksum(sources)
+    try:
+        return readCompiled(path, checksum)
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        compileCatalog(sources, path)
+        return readCompiled(path, checksum)
+    except (IOError, OSError): #can't write next to the sources
+        (names, columns) = parseSources(sources)
+        return Catalog(names, *columns)
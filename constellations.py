@@ -0,0 +1,164 @@
+"""
+Constellation figures for PyPlanetarium's quiz
+
+const/figures.txt holds stick figures for the 88 IAU constellations (and the
+two dippers the quiz starts with) as pairs of star names.  They are read once
+at startup and resolved against the catalog, so each Figure is just a set of
+edges between catalog rows and the set of rows they touch.  Switching quizzes
+or checking an answer never goes back to the file.
+
+DrawingGraph is the user's drawing as the same kind of edges, kept up to date
+one line at a time along with how it differs from the figure being quizzed,
+so checking an answer costs the same however much has been drawn.
+"""
+import collections
+
+FIGURE_MAGNITUDE = 7.0 #no stick ends on a star fainter than this
+
+
+class Figure(object):
+    def __init__(self, key, name):
+        self.key = key #"Ori", "bigdipper", ...
+        self.name = name #"Orion", "The Big Dipper", ...
+        self.edges = set() #(row, row) pairs, lower row first
+        self.stars = set() #rows
+        self.missing = [ ] #sticks naming stars the catalog doesn't have
+
+    def __repr__(self):
+        return "Figure(%r)" % self.key
+
+    def __len__(self):
+        return len(self.edges)
+
+    def addEdge(self, star1, star2):
+        #stars are catalog Star views; aliases and duplicate rows of a star
+        #all become its canonical row
+        edge = canonicalEdge(star1.key, star2.key)
+        if edge == None: return
+        self.edges.add(edge)
+        self.stars.update(edge)
+
+    def visible(self, catalog):
+        #True if every star of the figure is above the horizon
+        for row in self.stars:
+            if catalog.screenPos(row) == None: return False
+        return True
+
+
+class FigureLibrary(object):
+    def __init__(self):
+        self.figures = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.figures)
+
+    def __iter__(self):
+        return iter(self.figures)
+
+    def __contains__(self, key):
+        return key in self.figures
+
+    def __getitem__(self, key):
+        return self.figures[key]
+
+    def keys(self):
+        return list(self.figures.keys())
+
+    @staticmethod
+    def load(path, catalog):
+        #one block per figure: an unindented "key name" line, then indented
+        #"star|star" lines, one per stick; # starts a comment
+        library = FigureLibrary()
+        figure = None
+        #names are only looked for among the naked eye stars, so a big
+        #catalog's faint tail is never indexed for them
+        rows = catalog.rowsThrough(FIGURE_MAGNITUDE)
+        with open(path, "rt") as fin:
+            for line in fin:
+                if line.strip() == "" or line.lstrip().startswith("#"):
+                    continue
+                if not line[0].isspace():
+                    (key, name) = line.strip().split(" ", 1)
+                    figure = library.figures[key] = Figure(key, name.strip())
+                    continue
+                (name1, name2) = line.strip().split("|")
+                (star1, star2) = (catalog.find(name1, rows),
+                                  catalog.find(name2, rows))
+                if star1 == None or star2 == None:
+                    figure.missing.append((name1, name2))
+                else:
+                    figure.addEdge(star1, star2)
+        return library
+
+
+class DrawingGraph(object):
+    def __init__(self, figure=None):
+        self.edges = { } #edge -> how many lines are drawn along it
+        self.degree = { } #row -> how many line ends are on it
+        self.setFigure(figure)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def setFigure(self, figure):
+        #the only step that looks at the whole drawing; the quiz clears the
+        #drawing before switching figures, so it is empty here anyway
+        self.figure = figure
+        (edges, stars) = (set(), set())
+        if figure != None: (edges, stars) = (figure.edges, figure.stars)
+        self.missingEdges = edges - set(self.edges)
+        self.extraEdges = set(self.edges) - edges
+        self.missingStars = stars - set(self.degree)
+        self.extraStars = set(self.degree) - stars
+
+    def clear(self):
+        self.edges = { }
+        self.degree = { }
+        self.setFigure(self.figure)
+
+    def add(self, edge):
+        #edge comes from canonicalEdge; None (a line to nowhere) is ignored
+        if edge == None: return
+        count = self.edges.get(edge, 0)
+        self.edges[edge] = count + 1
+        if count == 0:
+            if edge in self.missingEdges: self.missingEdges.discard(edge)
+            else: self.extraEdges.add(edge)
+        for row in edge:
+            count = self.degree.get(row, 0)
+            self.degree[row] = count + 1
+            if count == 0:
+                if row in self.missingStars: self.missingStars.discard(row)
+                else: self.extraStars.add(row)
+
+    def remove(self, edge):
+        if edge == None or edge not in self.edges: return
+        count = self.edges[edge] - 1
+        if count > 0: self.edges[edge] = count
+        else:
+            del self.edges[edge]
+            if edge in self.extraEdges: self.extraEdges.discard(edge)
+            else: self.missingEdges.add(edge)
+        for row in edge:
+            count = self.degree[row] - 1
+            if count > 0:
+                self.degree[row] = count
+                continue
+            del self.degree[row]
+            if row in self.extraStars: self.extraStars.discard(row)
+            else: self.missingStars.add(row)
+
+    def matched(self):
+        #sticks of the figure that have been drawn
+        if self.figure == None: return 0
+        return len(self.figure.edges) - len(self.missingEdges)
+
+    def solved(self):
+        return (self.figure != None and len(self.missingEdges) == 0 and
+                len(self.extraEdges) == 0)
+
+
+def canonicalEdge(row1, row2):
+    #the same key whichever way a line was drawn; None for a star to itself
+    if row1 == row2: return None
+    return (min(row1, row2), max(row1, row2))
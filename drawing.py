@@ -0,0 +1,205 @@
+"""
+Saved drawings for PyPlanetarium
+
+A drawing is saved as JSON lines: first a header with the format version, the
+view it was drawn in and the catalog's row checksum, then one array per
+draw/erase action: [typeof, row1, row2, name1, name2].  Stars are stored by
+catalog row, which is all a load needs when the catalog is the same one;
+their names go alongside so the file still loads against a different one.
+Files are written and read a line at a time, so tens of thousands of strokes
+never sit in memory as text.
+
+The dot/pipe files older versions wrote are still read by readLegacy.
+
+While drawing, LineStore holds the finished lines and History the draw and
+erase actions that can be undone.  Lines know their own slot in the store,
+so drawing, erasing, undoing and redoing never search for a line, and the
+history keeps only the last HISTORY_CAP actions: anything older is already
+part of the lines on screen and is simply forgotten.
+"""
+import collections
+import datetime
+import json
+import numpy
+
+FORMAT = "pyplanetarium-drawing"
+VERSION = 1
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+LEGACY_DATE_FORMAT = "%Y %m %d %H %M"
+HISTORY_CAP = 1000 #undoable actions kept
+COMPACT_MIN = 64 #slots before tombstones are worth squeezing out
+
+
+class View(object):
+    #where a drawing was made: what loading it puts back on screen
+    def __init__(self, date, screenPos, shift, cityName):
+        self.date = date
+        self.screenPos = screenPos
+        self.shift = shift
+        self.cityName = cityName
+
+
+class LineStore(object):
+    #finished lines by slot; an erased line leaves None behind (a tombstone)
+    #so no other line moves, and the slots are packed again once more than
+    #half of them are tombstones.  rows holds each slot's two catalog rows
+    #(-1 for a tombstone) so all the lines can be positioned at once, and
+    #version counts changes so drawings of them know when they are stale.
+    def __init__(self):
+        self.slots = [ ]
+        self.live = 0
+        self.rows = numpy.zeros((COMPACT_MIN, 2), dtype=int)
+        self.version = 0
+
+    def __len__(self):
+        return self.live
+
+    def __iter__(self):
+        #oldest first, like they were drawn
+        for line in self.slots:
+            if line != None: yield line
+
+    def __contains__(self, line):
+        slot = getattr(line, "slot", None)
+        return slot != None and self.slots[slot] is line
+
+    def add(self, line):
+        line.slot = len(self.slots)
+        self.slots.append(line)
+        self.live += 1
+        if line.slot == len(self.rows): #room for twice as many
+            self.rows = numpy.concatenate((self.rows, self.rows))
+        self.rows[line.slot] = (line.star1.index, line.star2.index)
+        self.version += 1
+
+    def remove(self, line):
+        if line not in self: return
+        self.slots[line.slot] = None
+        self.rows[line.slot] = -1
+        line.slot = None
+        self.live -= 1
+        self.version += 1
+        if len(self.slots) > COMPACT_MIN and self.live < len(self.slots)//2:
+            self.compact()
+
+    def compact(self):
+        rows = self.pairs()
+        self.slots = [line for line in self.slots if line != None]
+        for (slot, line) in enumerate(self.slots):
+            line.slot = slot
+        spare = numpy.zeros((COMPACT_MIN, 2), dtype=int) #room to grow
+        self.rows = numpy.concatenate((rows, spare))
+
+    def clear(self):
+        for line in self.slots:
+            if line != None: line.slot = None
+        self.slots = [ ]
+        self.live = 0
+        self.rows = numpy.zeros((COMPACT_MIN, 2), dtype=int)
+        self.version += 1
+
+    def pairs(self):
+        #(live lines x 2) array of their catalog rows, oldest first
+        rows = self.rows[:len(self.slots)]
+        return rows[rows[:, 0] >= 0]
+
+
+class History(object):
+    #(typeof, line) actions, typeof "draw" or "erase"; undoing one hands it
+    #back for the caller to reverse and moves it over to the redo side
+    def __init__(self, cap=HISTORY_CAP):
+        self.cap = cap
+        self.done = collections.deque(maxlen=cap) #oldest fall off the end
+        self.undone = [ ]
+
+    def __len__(self):
+        return len(self.done)
+
+    def record(self, typeof, line):
+        #a new action means the undone ones can't be redone any more
+        self.done.append((typeof, line))
+        self.undone = [ ]
+
+    def undo(self):
+        if len(self.done) == 0: return None
+        action = self.done.pop()
+        self.undone.append(action)
+        return action
+
+    def redo(self):
+        if len(self.undone) == 0: return None
+        action = self.undone.pop()
+        self.done.append(action)
+        return action
+
+    def clear(self):
+        self.done.clear()
+        self.undone = [ ]
+
+
+def writeDrawing(path, view, actions, catalog):
+    #actions = [(typeof, star1, star2), ...] with typeof "draw" or "erase"
+    header = {"format": FORMAT, "version": VERSION,
+              "date": view.date.strftime(DATE_FORMAT),
+              "screenPos": [int(view.screenPos[0]), int(view.screenPos[1])],
+              "shift": view.shift, "city": view.cityName,
+              "catalog": catalog.rowChecksum(), "stars": len(catalog)}
+    #arrays and no sort_keys keep json on its C encoder
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    with open(path, "wt") as fout:
+        fout.write(json.dumps(header, sort_keys=True) + "\n")
+        for (typeof, star1, star2) in actions:
+            fout.write(encoder.encode([typeof, star1.index, star2.index,
+                                       star1.name, star2.name]) + "\n")
+
+def readDrawing(path, catalog):
+    #(view, [(typeof, star1, star2), ...]) in the order they were saved;
+    #actions naming stars this catalog doesn't have are left out.  Raises
+    #ValueError if the file isn't a drawing.
+    with open(path, "rt") as fin:
+        first = fin.readline()
+        if not first.lstrip().startswith("{"):
+            return readLegacy(first, fin, catalog)
+        header = json.loads(first)
+        if header.get("format") != FORMAT:
+            raise ValueError("not a drawing")
+        if header.get("version") != VERSION:
+            raise ValueError("not a version %d drawing" % VERSION)
+        view = View(datetime.datetime.strptime(header["date"], DATE_FORMAT),
+                    tuple(header["screenPos"]), header["shift"],
+                    str(header["city"]))
+        #same rows: no name lookups at all
+        sameRows = (header.get("catalog") == catalog.rowChecksum() and
+                    header.get("stars") == len(catalog))
+        actions = [ ]
+        for line in fin:
+            if line.strip() == "": continue
+            (typeof, row1, row2, name1, name2) = json.loads(line)
+            if sameRows:
+                (star1, star2) = (catalog[row1], catalog[row2])
+            else:
+                (star1, star2) = (catalog.find(name1), catalog.find(name2))
+                if star1 == None or star2 == None: continue
+            actions.append((str(typeof), star1, star2))
+    return (view, actions)
+
+def readLegacy(first, lines, catalog):
+    #the old format: "YYYY mm dd HH MM", then "left.up.shift.city", then one
+    #"typeof.star1|star2" per action
+    date = datetime.datetime.strptime(first.strip(), LEGACY_DATE_FORMAT)
+    view = None
+    actions = [ ]
+    for line in lines:
+        line = line.strip()
+        if line == "": continue
+        if view == None:
+            (left, up, shift, city) = line.split(".", 3)
+            view = View(date, (int(left), int(up)), int(shift), city)
+            continue
+        (typeof, pair) = line.split(".", 1)
+        (name1, name2) = pair.split("|")
+        (star1, star2) = (catalog.find(name1), catalog.find(name2))
+        if star1 == None or star2 == None: continue #not in this catalog
+        actions.append((typeof, star1, star2))
+    if view == None: raise ValueError("not a drawing")
+    return (view, actions)
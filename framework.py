@@ -50,8 +50,27 @@ class Framework(object):
         pass
 
     def redrawAll(self, screen):
+        ''' draw the frame; when layered, return a list of the Rects drawn
+            over the background (None means the whole screen changed) '''
         pass
 
+    def layered(self):
+        ''' whether this frame is drawn over the cached background layer '''
+        return False
+
+    def redrawBackground(self, surface):
+        ''' draw the parts of the frame that rarely change '''
+        pass
+
+    def backgroundChanged(self):
+        ''' return whether the background layer must be redrawn '''
+        return True
+
+    def isAnimating(self):
+        ''' return whether frames should come at the full frame rate; when
+            False, run() sleeps until an event arrives (or idleTimeout) '''
+        return True
+
     def isKeyPressed(self, key):
         ''' return whether a specific key is being held '''
         return self._keys.get(key, False)
@@ -70,7 +89,51 @@ class Framework(object):
         self.smallFont = pygame.font.SysFont("monospace", 12)
         self.font = pygame.font.SysFont("monospace", self.fontSize)
         self.bigFont = pygame.font.SysFont("monospace", 25, True)
-
+        # frame scheduling: "active" runs at fps, "idle" waits for events
+        self.schedulerMode = "active"
+        self.idleTimeout = 1000 # ms between frames while idle
+        self.frameTime = 0 # ms spent on the last frame
+        self._wakeEvent = pygame.USEREVENT
+
+    def waitForEvents(self):
+        ''' block until an event arrives or idleTimeout ms have passed '''
+        try:
+            event = pygame.event.wait(self.idleTimeout)
+        except TypeError:
+            # pygame 1.x has no timeout, so a timer event wakes us instead
+            pygame.time.set_timer(self._wakeEvent, self.idleTimeout)
+            event = pygame.event.wait()
+            pygame.time.set_timer(self._wakeEvent, 0)
+        events = [event] + pygame.event.get()
+        return [event for event in events
+                if event.type != pygame.NOEVENT and
+                   event.type != self._wakeEvent]
+
+    def drawFrame(self, screen):
+        if not self.layered():
+            screen.fill(self.bgColor)
+            self.redrawAll(screen)
+            pygame.display.flip()
+            self._dirtyRects = None
+            return
+        full = self.backgroundChanged() or self._dirtyRects == None
+        if full:
+            self._background.fill(self.bgColor)
+            self.redrawBackground(self._background)
+            screen.blit(self._background, (0, 0))
+        else:
+            # erase last frame's foreground
+            for rect in self._dirtyRects:
+                screen.blit(self._background, rect, rect)
+        rects = self.redrawAll(screen)
+        if rects != None:
+            rects = [rect for rect in rects if rect]
+        if full or rects == None:
+            pygame.display.flip()
+        else:
+            # only push what changed: last frame's foreground and this one's
+            pygame.display.update(self._dirtyRects + rects)
+        self._dirtyRects = rects
 
     def run(self):
 
@@ -78,6 +141,9 @@ class Framework(object):
         screen = pygame.display.set_mode((self.width, self.height))
         # set the title of the window
         pygame.display.set_caption(self.title)
+        # off-screen layer reused while backgroundChanged() is False
+        self._background = pygame.Surface((self.width, self.height)).convert()
+        self._dirtyRects = None
 
         # stores all the keys currently being held down
         self._keys = dict()
@@ -86,10 +152,18 @@ class Framework(object):
         self.init()
         playing = True
         while playing:
-            time = clock.tick(self.fps)
+            if self.isAnimating():
+                self.schedulerMode = "active"
+                time = clock.tick(self.fps)
+                events = pygame.event.get()
+            else:
+                self.schedulerMode = "idle"
+                events = self.waitForEvents()
+                time = clock.tick()
+            start = pygame.time.get_ticks()
             self.timerFired(time)
             
-            for event in pygame.event.get():
+            for event in events:
                 if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                     self.mousePressed(*(event.pos))
                 elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 4:
@@ -112,8 +186,7 @@ class Framework(object):
                     self.keyReleased(event.key, event.mod)
                 elif event.type == pygame.QUIT:
                     playing = False
-            screen.fill(self.bgColor)
-            self.redrawAll(screen)
-            pygame.display.flip()
+            self.drawFrame(screen)
+            self.frameTime = pygame.time.get_ticks() - start
 
         pygame.quit()
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+Multi-core sky computation for PyPlanetarium
+
+SkyEngine.compute() is one numpy pass over the catalog, on one core.  With a
+large catalog ParallelSky splits that pass into shards and hands them to a
+pool of worker processes that is started once and kept.  The workers are
+forked after the catalog is loaded, so they already have it (a compiled
+catalog is memory mapped, so it isn't even copied), and they write their
+shard's results straight into arrays in shared memory, so nothing but a few
+numbers goes through pickling.  Apparent positions stay in shared memory
+too, so incremental time steps only send the new sidereal time.
+
+All of that relies on the workers being forked.  Where they would be
+spawned instead (Windows, or a Python 3 start method other than fork)
+ParallelSky starts no pool and the engine computes everything itself.
+
+Starting a shard costs about a millisecond whatever its size, so small
+catalogs are computed in the main process as before: minStars is where
+parallel starts to win.  Run this file to measure it on this machine:
+
+    $ python parallel.py [hip.csv ...] [--processes 4]
+"""
+from __future__ import division
+import os
+import multiprocessing
+import multiprocessing.sharedctypes
+import time
+import numpy
+import ephem
+from sky import refract, horizonAt, spherePoints
+
+MIN_STARS = 50000 #fewer than this are computed in the main process
+SHARDS_PER_PROCESS = 2
+
+
+#what each worker was given when the pool started
+workerEngine = None
+workerArrays = None
+
+def forks():
+    #True if pool workers are forked from this process, so they can use its
+    #memory-mapped catalog and shared arrays as they are; spawned ones would
+    #get pickled copies (or nothing, for the mmap)
+    getMethod = getattr(multiprocessing, "get_start_method", None)
+    if getMethod == None: return os.name == "posix" #Python 2 forks there
+    return getMethod() == "fork"
+
+def sharedArray(count, columns=1):
+    #float64 array in shared memory that forked processes see too
+    raw = multiprocessing.sharedctypes.RawArray("d", max(1, count*columns))
+    array = numpy.frombuffer(raw, dtype=float)[:count*columns]
+    if columns > 1: array = array.reshape((count, columns))
+    return array
+
+def startWorker(engine, arrays):
+    global workerEngine, workerArrays
+    (workerEngine, workerArrays) = (engine, arrays)
+
+def computeShard(task):
+    #the same steps as SkyEngine.compute, for stars start to end
+    (date, lst, lat, pressure, temp, full, start, end) = task
+    (apparent, alt, az, x, y) = workerArrays
+    if full:
+        apparent[start:end] = workerEngine.apparentPositions(date, start, end)
+    (shardAlt, shardAz) = horizonAt(apparent[start:end], lst, lat)
+    alt[start:end] = refract(shardAlt, pressure, temp)
+    az[start:end] = shardAz
+    (x[start:end], y[start:end]) = spherePoints(alt[start:end], shardAz)
+    return end - start
+
+
+class ParallelSky(object):
+    #set as engine.parallel; start it after the catalog is loaded and before
+    #anything else the workers shouldn't inherit
+    def __init__(self, engine, processes=None, minStars=MIN_STARS):
+        if processes == None: processes = multiprocessing.cpu_count()
+        if not forks(): processes = 1 #never worthwhile; see forks()
+        self.processes = processes
+        self.minStars = minStars
+        n = len(engine)
+        self.view = None #what engine.apparent is while it's the shared one
+        self.apparent = sharedArray(n, 3)
+        (self.alt, self.az) = (sharedArray(n), sharedArray(n))
+        (self.x, self.y) = (sharedArray(n), sharedArray(n))
+        self.pool = None
+        if processes > 1:
+            self.pool = multiprocessing.Pool(processes, startWorker,
+                        (engine, (self.apparent, self.alt, self.az,
+                                  self.x, self.y)))
+
+    def close(self):
+        if self.pool == None: return
+        self.pool.terminate()
+        self.pool.join()
+
+    def worthwhile(self, count):
+        return self.processes > 1 and count >= self.minStars
+
+    def holds(self, apparent):
+        #True if apparent positions are the ones in shared memory, so the
+        #workers can go on from them without a full compute
+        return apparent is not None and apparent is self.view
+
+    def shards(self, count):
+        #(start, end) pieces of the first count stars
+        pieces = self.processes * SHARDS_PER_PROCESS
+        ends = numpy.linspace(0, count, pieces + 1).astype(int).tolist()
+        return [(ends[i], ends[i+1]) for i in range(pieces)
+                                     if ends[i+1] > ends[i]]
+
+    def compute(self, engine, observer, full):
+        #(alt, az, x, y) of the engine's active stars, like its own compute();
+        #full is False only if holds(engine.apparent)
+        n = engine.active
+        date = float(observer.date)
+        if full:
+            #the workers only keep their matrix to themselves; no stars, just
+            #this process's engine.matrix for the frame
+            engine.apparentPositions(date, 0, 0)
+            engine.apparent = self.view = self.apparent[:n]
+        (lst, lat) = (float(observer.sidereal_time()), float(observer.lat))
+        tasks = [(date, lst, lat, observer.pressure, observer.temp, full,
+                  start, end) for (start, end) in self.shards(n)]
+        self.pool.map(computeShard, tasks)
+        #views, written over by the next compute; SkyEngine.snapshot copies
+        #them if it's asked to keep them
+        return (self.alt[:n], self.az[:n], self.x[:n], self.y[:n])
+
+
+def benchmark(engine, processes=None, sizes=None, repeat=3):
+    #serial and parallel full computes for growing prefixes of the catalog;
+    #returns [(stars, serial ms, parallel ms), ...] and the smallest size
+    #where parallel was faster (None if it never was)
+    observer = ephem.Observer()
+    (observer.lat, observer.long) = ("40:26:26.3", "-79:59:45.20")
+    observer.date = ephem.Date("2015/12/10 02:00")
+    if sizes == None:
+        sizes = [size for size in (1000, 3000, 10000, 30000, 100000, 300000,
+                                   1000000, 3000000) if size < len(engine)]
+        sizes.append(len(engine))
+    if not forks():
+        raise ValueError("workers can't be forked here, so there is no "
+                         "parallel computing to measure")
+    parallel = ParallelSky(engine, processes, minStars=0)
+    rows = [ ]
+    try:
+        for size in sizes:
+            engine.setActive(size)
+            times = [ ]
+            for backend in (None, parallel):
+                engine.parallel = backend
+                best = None
+                for i in range(repeat):
+                    engine.apparent = None #a full compute every time
+                    start = time.time()
+                    engine.compute(observer)
+                    elapsed = (time.time() - start)*1000
+                    if best == None or elapsed < best: best = elapsed
+                times.append(best)
+            rows.append((size, times[0], times[1]))
+    finally:
+        engine.parallel = None
+        engine.setActive(len(engine))
+        parallel.close()
+    crossover = None
+    for (size, serial, shared) in rows:
+        if shared < serial:
+            crossover = size
+            break
+    return (rows, crossover)
+
+
+if __name__ == "__main__":
+    import argparse
+    from catalog import loadCatalog, BUILTIN
+    parser = argparse.ArgumentParser(description="Find where computing the "
+                                     "sky over several processes pays off")
+    parser.add_argument("catalogs", nargs="*",
+                        help="extra .edb/.csv catalogs, as for planetarium.py")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    args = parser.parse_args()
+    catalog = loadCatalog([BUILTIN, "ybs.edb"] + args.catalogs)
+    processes = args.processes or multiprocessing.cpu_count()
+    print "%d stars, %d processes" % (len(catalog), processes)
+    if not forks():
+        print "Workers can't be forked here; the sky is computed in one process"
+        raise SystemExit(1)
+    (rows, crossover) = benchmark(catalog, processes)
+    print "%10s %12s %12s" % ("stars", "serial ms", "parallel ms")
+    for (size, serial, shared) in rows:
+        print "%10d %12.1f %12.1f" % (size, serial, shared)
+    if crossover == None:
+        print "Parallel never won here; keep computing in one process"
+    else:
+        print "Parallel wins from about %d stars (minStars)" % crossover
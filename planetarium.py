@@ -18,13 +18,22 @@ Icon images obtained from Google Images.
 """
 import pygame
 from framework import Framework 
+from sky import SkyCache
+from catalog import loadCatalog, BUILTIN
+from render import GlyphCache, LevelOfDetail, LabelPlacer
+from spatial import GridIndex, SegmentIndex
+from constellations import FigureLibrary, DrawingGraph, canonicalEdge
+from drawing import View, writeDrawing, readDrawing
+from drawing import LineStore, History, HISTORY_CAP
+from parallel import ParallelSky
 import ephem
 import ephem.stars
 import ephem.cities
+import argparse
 import datetime, time
 import math
-import copy
 import os
+import numpy
 
 """
 TODO MASTER LIST:
@@ -36,15 +45,9 @@ TODO MASTER LIST:
 
 
 
-# read/writeFile from the class notes on Basic File I/O
-# http://www.cs.cmu.edu/~112/notes/notes-strings.html#basicFileIO
-def readFile(filename, mode="rt"):       # rt = "read text"
-    with open(filename, mode) as fin:
-        return fin.read()
-
-def writeFile(filename, contents, mode="wt"):    # wt = "write text"
-    with open(filename, mode) as fout:
-        fout.write(contents)
+#PyEphem's stars, then more from Yale's Bright Star catalog; catalogs given
+#on the command line come after these
+CATALOG_SOURCES = [BUILTIN, "ybs.edb"]
 
 def pointInBox(point, boxCoords): #from my hw8a.py
     (x, y) = point
@@ -57,65 +60,25 @@ def pointInCircle(point, circlePos, r):
     return (x-cx)**2 + (y-cy)**2 <= r**2
 
 
-class Star(object):
-    def __init__(self, name, body):
-        self.name = name
-        self.body = body #type == ephem.Body
-        self.screenPos = None
-        self.showInfo = False
-        self.r = 1
-
-    def __str__(self):
-        return self.name
-
-    def __eq__(self, other):
-        return isinstance(other, Star) and self.name == other.name
-
-    def __hash__(self):
-        return hash(self.name)
-
-    def changeInfo(self):
-        self.showInfo = not self.showInfo
-
-    def calculate(self, ref, shift): #ref = city, shift = Planetarium.shift
-        self.body.compute(ref)
-        self.r = int(self.body.mag)
-        if self.body.alt < 0: #below horizon
-            self.screenPos = None
-            return #do nothing, screenPos remains None
-        phi = self.body.alt + math.pi/2
-        theta = 2*math.pi - self.body.az
-        #convert from spherical to cartesian xy coordinates
-        #constant sphere radius
-        x = math.sin(phi)*math.cos(theta)
-        y = math.sin(phi)*math.sin(theta)
-        #convert to draw-able coordinates
-        #stores them based on "big" screen, not "current" screen
-        self.screenPos = (shift * (x + 1), shift * (-y + 1))
-
-    def displayPos(self, left, up):
-        if self.screenPos == None: return None
-        (x,y) = self.screenPos
-        return (int(x - left), int(y - up))
-
 class Line(object):
+    #just two catalog stars: the lines layer gets every line's position from
+    #the catalog's arrays in one go (see drawLines), so a line never has to
+    #be told the view moved
     def __init__(self, startStar, screenPos, endStar=None):
-        self.screenPos = screenPos
-        (left, up) = screenPos
         self.star1 = startStar
-        (self.dispX1, self.dispY1) = self.star1.displayPos(left, up)
-        (self.x1, self.y1) = self.star1.screenPos
         self.star2 = endStar
-        (self.x2, self.y2) = self.star1.screenPos
-        (self.dispX2, self.dispY2) = (self.dispX1, self.dispY1)
+        (left, up) = screenPos
+        self.mousePos = self.star1.displayPos(left, up) #the loose end
         self.color = (255, 255, 255) #white
         self.width = 2
+        self.slot = None #where it is in the LineStore, if it's in one
+        self.edgeKey = None #see edge()
 
-    def __hash__(self):
-        if self.star2 != None:
-            return hash(self.star1.name) + hash(self.star2.name)
-        else:
-            return hash(self.star1.name) + hash("None")
+    #lines are only ever the same line if they are the same object (the
+    #store and the line index rely on that); edge() is what compares them
+    def edge(self):
+        #key the drawing graph knows this line by; None while being drawn
+        return self.edgeKey
 
     def __repr__(self):
         if self.star2 != None:
@@ -123,46 +86,22 @@ class Line(object):
         else:
             return self.star1.name+"|"+"None"
 
-    def __eq__(self, other):
-        return (isinstance(other, Line) and (other.star1 == self.star1 
-                and other.star2 == self.star2) or (other.star1 == self.star2
-                and other.star2 == self.star1))
-
-    def onClick(self, x, y):
-        #point distance from a line equation
-        (x1, y1, x2, y2) = (self.dispX1, self.dispY1, self.dispX2, self.dispY2)
-        d = abs((x2-x1)*(y1-y) - (x1-x)*(y2-y1))
-        denom = math.sqrt((x2-x1)**2 + (y2-y1)**2)
-        if denom != 0: d /= denom
-        return d <= 3*self.width
-
-    def setEnd(self, star, ref):
-        (left, up) = ref
+    def setEnd(self, star):
         self.star2 = star
-        (self.x2, self.y2) = self.star2.screenPos
-        (self.dispX2, self.dispY2) = self.star2.displayPos(left, up)
-
-    def updateLine(self, ref):
-        (left, up) = ref
-        (self.dispX1, self.dispY1) = self.star1.displayPos(left, up)
-        (self.dispX2, self.dispY2) = self.star2.displayPos(left, up)
+        self.edgeKey = canonicalEdge(self.star1.key, self.star2.key)
 
     def updateEndPoint(self, x, y):
         #only used temporarily for aesthetic purposes
-        self.dispX2 = x
-        self.dispY2 = y
-
-    def displayPoints(self, ref):
-        (left, up) = ref
-        if self.star2 == None:
-            return (self.star1.displayPos(left,up), (self.dispX2, self.dispY2))
-        else:
-            return (self.star1.displayPos(left, up), 
-                    self.star2.displayPos(left, up))
+        self.mousePos = (x, y)
 
     def draw(self, screen, ref):
-        (start, end) = self.displayPoints(ref)
-        pygame.draw.line(screen, self.color, start, end, self.width)
+        #one line on its own, for the one still following the mouse
+        (left, up) = ref
+        start = self.star1.displayPos(left, up)
+        end = self.mousePos
+        if self.star2 != None: end = self.star2.displayPos(left, up)
+        if start == None or end == None: return None #below the horizon
+        return pygame.draw.line(screen, self.color, start, end, self.width)
 
 class Hint(object):
     def __init__(self, x, y, text, width, height):
@@ -186,16 +125,18 @@ class Hint(object):
             return True
         return False
 
-    def draw(self, screen, font):
+    def draw(self, screen, font, glyphs):
         if self.show:
-            pygame.draw.rect(screen, self.bgcolor, 
+            rect = pygame.draw.rect(screen, self.bgcolor, 
                 pygame.Rect(self.x, self.y, self.width, self.height))
-            text = font.render(self.text, 1, self.textcolor)
-            screen.blit(text, (self.x+self.width//2-font.size(self.text)[0]//2, 
-                            self.y+self.height//3-font.size(self.text)[1]//2))
-            text2 = font.render(self.text2, 1, self.textcolor)
-            screen.blit(text2, (self.x+self.width//2-font.size(self.text2)[0]//2, 
-                        self.y+self.height*2//3-font.size(self.text2)[1]//2))
+            text = glyphs.render(font, self.text, self.textcolor)
+            (width, height) = glyphs.size(font, self.text)
+            rect = rect.union(screen.blit(text, 
+                (self.x+self.width//2-width//2, self.y+self.height//3-height//2)))
+            text2 = glyphs.render(font, self.text2, self.textcolor)
+            (width, height) = glyphs.size(font, self.text2)
+            return rect.union(screen.blit(text2, (self.x+self.width//2-width//2, 
+                        self.y+self.height*2//3-height//2)))
 
     def setText(self, text):
         self.text = text
@@ -216,32 +157,32 @@ class Button(object):
                                 self.x+self.width, self.y+self.height))
         
 
-    def draw(self, screen, font):
+    def draw(self, screen, font, glyphs):
         #todo use images instead of pygame drawing?
-        pygame.draw.rect(screen, self.BLACK, pygame.Rect(self.x, self.y, 
-                                            self.width, self.height), 1)
-        screen.fill(self.color, pygame.Rect(self.x, self.y, 
-                                            self.width, self.height))
+        rect = pygame.Rect(self.x, self.y, self.width, self.height)
+        pygame.draw.rect(screen, self.BLACK, rect, 1)
+        screen.fill(self.color, rect)
+        return rect
 
 class HintButton(Button):
     def __init__(self, name, x, y, color, width=50, height=50):
         super(HintButton, self).__init__(name, x, y, color, width, height)
         self.icon = pygame.image.load(os.path.join('icons', self.name+'.png'))
 
-    def draw(self, screen, font):
-        screen.blit(self.icon, (self.x, self.y))
+    def draw(self, screen, font, glyphs):
+        return screen.blit(self.icon, (self.x, self.y))
         
 class ModeButton(Button):
     def __init__(self, name, x, y, color, width=25, height=15):
         super(ModeButton, self).__init__(name, x, y, color, width, height)
 
-    def draw(self, screen, font): 
+    def draw(self, screen, font, glyphs): 
         word = self.name[0].upper() + self.name[1:]
         if (self.width, self.height) == (25, 15): #defaults
-            (self.width, self.height) = font.size(word)
-        super(ModeButton, self).draw(screen, font)
-        text = font.render(word, 1, self.BLACK)
-        screen.blit(text, (self.x, self.y))
+            (self.width, self.height) = glyphs.size(font, word)
+        rect = super(ModeButton, self).draw(screen, font, glyphs)
+        text = glyphs.render(font, word, self.BLACK)
+        return rect.union(screen.blit(text, (self.x, self.y)))
 
     def onClick(self, x, y):
         if pointInBox((x,y), (self.x, self.y, self.x+self.width, 
@@ -290,21 +231,22 @@ class TimeButton(Button):
         if pointInBox((x,y), (self.x, self.y, self.x+self.width, 
                                             self.y+self.height)):
             return self
-    def draw(self, screen, font):
-        super(TimeButton, self).draw(screen, font)
-        text = font.render(str(self.timeVal), 1, self.BLACK)
-        screen.blit(text, (self.x, self.y))
+    def draw(self, screen, font, glyphs):
+        rect = super(TimeButton, self).draw(screen, font, glyphs)
+        text = glyphs.render(font, str(self.timeVal), self.BLACK)
+        rect = rect.union(screen.blit(text, (self.x, self.y)))
         name = self.name[0].upper() + self.name[1:]
-        text = font.render(name, 1, self.WHITE)
-        screen.blit(text, (self.x+self.width//2-font.size(name)[0]//2, 
-                            self.y-font.size(name)[1]-5))
+        text = glyphs.render(font, name, self.WHITE)
+        (width, height) = glyphs.size(font, name)
+        return rect.union(screen.blit(text, (self.x+self.width//2-width//2, 
+                            self.y-height-5)))
 
 class NowButton(Button):
-    def draw(self, screen, font):
+    def draw(self, screen, font, glyphs):
         word = self.name[0].upper() + self.name[1:]
-        super(NowButton, self).draw(screen, font)
-        text = font.render(word, 1, self.BLACK)
-        screen.blit(text, (self.x, self.y))
+        rect = super(NowButton, self).draw(screen, font, glyphs)
+        text = glyphs.render(font, word, self.BLACK)
+        return rect.union(screen.blit(text, (self.x, self.y)))
 
     def onClick(self, x, y):
         if pointInBox((x,y), (self.x, self.y, self.x+self.width, 
@@ -324,16 +266,16 @@ class ToggleButton(Button):
                                             self.y+self.height)):
             self.toggle = not self.toggle
             return self.toggle
-    def draw(self, screen, font):
+    def draw(self, screen, font, glyphs):
         if self.toggle:
             word = "ON"
             self.color = self.onColor
         else:
             word = "OFF"
             self.color = self.offColor
-        super(ToggleButton, self).draw(screen, font)
-        text = font.render(word, 1, self.BLACK)
-        screen.blit(text, (self.x, self.y))
+        rect = super(ToggleButton, self).draw(screen, font, glyphs)
+        text = glyphs.render(font, word, self.BLACK)
+        return rect.union(screen.blit(text, (self.x, self.y)))
 
 class ListButton(Button):
     def __init__(self,  name, x, y, color, data, width=25, height=15):
@@ -371,11 +313,11 @@ class ListButton(Button):
                                             self.y+self.height)):
             return self
 
-    def draw(self, screen, font):
-        (self.width, self.height) = font.size("OOOOOOOOOOOOOO")
-        super(ListButton, self).draw(screen, font)
-        text = font.render(self.selectedWord, 1, self.BLACK)
-        screen.blit(text, (self.x, self.y))
+    def draw(self, screen, font, glyphs):
+        (self.width, self.height) = glyphs.size(font, "OOOOOOOOOOOOOO")
+        rect = super(ListButton, self).draw(screen, font, glyphs)
+        text = glyphs.render(font, self.selectedWord, self.BLACK)
+        return rect.union(screen.blit(text, (self.x, self.y)))
 
 
 class DrawButton(Button):
@@ -384,11 +326,11 @@ class DrawButton(Button):
         self.icon = pygame.image.load(os.path.join('icons', name+'.png'))
 
     def drawSelected(self, screen):
-        pygame.draw.rect(screen, self.color, 
+        return pygame.draw.rect(screen, self.color, 
                         pygame.Rect(self.x, self.y, self.width, self.height))
 
-    def draw(self, screen, font):
-        screen.blit(self.icon, (self.x, self.y))
+    def draw(self, screen, font, glyphs):
+        return screen.blit(self.icon, (self.x, self.y))
 
     def onClick(self, x, y):
         if pointInBox((x,y), (self.x, self.y, self.x+self.width, 
@@ -397,9 +339,20 @@ class DrawButton(Button):
 
 
 class Planetarium(Framework):
-    def __init__(self, width=1000, height=666, fps=50, title="PyPlanetarium"):
+    def __init__(self, width=1000, height=666, fps=50, title="PyPlanetarium",
+                 catalogs=(), historyCap=HISTORY_CAP, processes=1,
+                 warmUpGlyphs=True):
+        self.extraCatalogs = list(catalogs) #.edb/.csv files given to run
+        self.processes = processes #for star positions; None for every core
+        #before pygame starts, so processes computing star positions aren't
+        #forked from one with SDL running in it
+        self.initCatalog()
         super(Planetarium, self).__init__(width, height, fps, title)
+        self.historyCap = historyCap #undoable actions in draw mode
+        #rasterize star names at startup rather than on first sight
+        self.warmUpGlyphs = warmUpGlyphs
         self.initBasics() 
+        self.initGlyphs()
 
         self.initColors()
         self.initButtons()
@@ -416,14 +369,42 @@ class Planetarium(Framework):
 
         self.infostar = None
         self.infopos = None
+        self.hoverInfo = False #show star info on hover instead of click
+        self.starLayerKey = None #what the background star layer shows
         self.lastMode = None
         self.initSplash()
         self.initHelp()
         self.initQuiz()
 
+    def run(self):
+        try:
+            super(Planetarium, self).run()
+        finally: #however the window was closed
+            self.closeCatalog()
+
 
 ################################# INIT FUNCTIONS ##############################
 
+    def initCatalog(self):
+        #PyEphem's stars, then more from Yale's Bright Star catalog and any
+        #catalogs given on the command line, compiled to a .cat file next to
+        #the last of them the first time (and whenever the sources change)
+        self.catalogSources = CATALOG_SOURCES + self.extraCatalogs
+        #one array per field; positions for the whole catalog are computed in
+        #one vectorized pass
+        self.catalog = loadCatalog(self.catalogSources)
+        #big catalogs can be computed over several processes; small ones
+        #(and views cut down to few stars) still are computed here
+        if self.processes != 1:
+            self.catalog.parallel = ParallelSky(self.catalog, self.processes)
+
+    def closeCatalog(self):
+        #stops the processes computing star positions, if there are any;
+        #anything computed after this is computed here
+        if self.catalog.parallel != None:
+            self.catalog.parallel.close()
+            self.catalog.parallel = None
+
     def initBasics(self):
         self.title = "PyPlanetarium"
         self.bgColor = self.BLACK
@@ -433,6 +414,8 @@ class Planetarium(Framework):
         self.minZoom = 500
         self.maxZoom = 10000
         self.shiftChange = 10
+        self.lastZoom = 0 #time.time() of the last scroll
+        self.zoomSettle = 0.25 #seconds a zoom counts as underway
 
         (self.MIN_ALT, self.MAX_ALT) = (0, math.pi/2)
         (self.MIN_AZ, self.MAX_AZ) = (0, 2*math.pi) #radians
@@ -440,16 +423,42 @@ class Planetarium(Framework):
         # starts w/ center of screen being (0,0) of sky
         self.screenPos = (self.shift-self.width//2, self.shift-self.height//2)
         self.date = datetime.datetime.now() #always Datetime form
-        self.starList = [ ]
         self.cities = [city for city in ephem.cities._city_data]
         self.cities.sort()
         self.initPittsburgh()
         self.city = self.pgh
         self.cityName = "Pittsburgh"
-        self.initStars()
-        #read in more stars!
-        yaleCatalog = self.readInDB("ybs.edb")
-        self.starList += yaleCatalog #using Yale's Bright Star catalog
+        #(shift, faintest magnitude, most labels) for a few zoom levels; the
+        #faintest stars are only computed and drawn when zoomed in, and
+        #labels are given to the brightest stars first.  All of YBS shows
+        #at every zoom.
+        self.levelOfDetail = LevelOfDetail(((self.minZoom, 8.0, 250),
+                                            (1400, 9.8, 400),
+                                            (3000, 11.0, 600),
+                                            (self.maxZoom, 13.0, 800)))
+        self.skyResolution = 1 #seconds; finer date changes reuse positions
+        self.skyCache = SkyCache(self.catalog, self.skyResolution)
+        #for finding the star under the mouse: dots are looked up in the
+        #catalog's own sky cells, which don't change with panning, and the
+        #labels placed for the current view have a grid of their own
+        self.dotReach = 20 #no dot is bigger than this around its center
+        self.labelIndex = GridIndex()
+        self.labelIndexPlacements = None #labelPlacements() it was built from
+        #labels that don't overlap, for the brightest stars on screen;
+        #up to labelCandidates times the budget are tried
+        self.labelPlacer = LabelPlacer()
+        self.labelCandidates = 4
+
+    def initGlyphs(self):
+        #every button and label renders its text through here so each
+        #string is only rasterized once; it's keyed on this instance's
+        #fonts, so it goes with the instance
+        self.glyphs = GlyphCache()
+        #star names are drawn every frame; rasterize them all up front
+        if self.warmUpGlyphs:
+            #brightest first, as many as the cache holds
+            names = self.catalog.names[:self.glyphs.maxSize]
+            self.glyphs.warmUp(self.smallFont, names, self.GREEN)
 
     def initColors(self):
         self.LIGHT_BLUE = (114, 164, 255) 
@@ -466,9 +475,14 @@ class Planetarium(Framework):
         HintButton("hint", self.width-size, self.height-size, self.YELLOW,
                                                                     size, size)
         ]
+        #every figure is read and resolved to catalog rows once, here
+        self.figures = FigureLibrary.load(os.path.join("const",
+                                            "figures.txt"), self.catalog)
         self.constindex = 0
-        self.quizzes = ["bigdipper", "littledipper"]
+        self.quizzes = self.figures.keys() #the dippers, then the 88 IAU
         self.const = self.quizzes[0]
+        self.figure = self.figures[self.const]
+        self.graph.setFigure(self.figure)
 
     def initSplash(self):
         self.splashScreen = pygame.image.load(os.path.join("screens",
@@ -478,6 +492,7 @@ class Planetarium(Framework):
                     self.bigFont.size("GO")[0],  self.bigFont.size("GO")[1])
         ]
         self.inFastTime = True
+        self.fastTimeStep = 1 #simulated minutes per frame
 
     def initButtons(self):
         self.buttons = [ 
@@ -529,22 +544,18 @@ class Planetarium(Framework):
             DrawButton("savefile", 0, self.height*7//8, self.YELLOW, size, size)
                                 ]
         self.onLine = False
-        self.lines = [ ]
-        self.undidLines = [ ]
-        self.undidActions = [ ] 
-        self.erasedLines = [ ] 
-        self.lastAction = "draw"
+        self.newLine = None #the line following the mouse while onLine
+        self.lines = LineStore() #finished lines
+        self.graph = DrawingGraph() #the same lines, checked by the quiz
+        self.history = History(self.historyCap)
+        #lines by where they are on the "big" screen, for erasing; good
+        #until the sky moves (lineIndexView)
+        self.lineIndex = SegmentIndex(cellSize=50, pad=6)
+        self.lineIndexView = None
         self.selectedDrawButton = None
         self.drawMode = "draw"
-        self.actions = [ ]
         self.iconSize = 50
 
-    def initStars(self): #FLAG
-        for star in ephem.stars.db.split("\n"):
-            starName = star.split(",")[0]
-            if starName == "": continue #not a star
-            self.starList.append(Star(starName, ephem.star(starName)))
-
     def initPittsburgh(self):
         self.pgh = ephem.Observer()
         self.pgh.lat = "40:26:26.3"
@@ -556,90 +567,146 @@ class Planetarium(Framework):
 ########################## LOAD FROM FILE FUNCTIONS ###########################
 
 
-    def readInDB(self, path):
-        #returns list of Star objects from all stars in DB
-        db = readFile(path)
-        starList = [ ] 
-        for line in db.splitlines():
-            if line.startswith("#") or line == "": continue
-            line = line.strip()
-            body = ephem.readdb(line)
-            if body.name == "Benetnasch": continue #duplicate of Alkaid
-            starList.append(Star(body.name, body))
-        return starList
-
     def unpackFile(self, source="savedata.txt", folder=""):
         directory = os.getcwd()
         if folder == "": pass
         else:
             directory = os.path.join(directory, folder)
-        lines = [ ]
-        actions = [ ] 
         if source not in os.listdir(directory):
             return 1
             #TODO:popup saying "not available, chk filename savedata.txt"
-        info = readFile(os.path.join(directory, source)).splitlines()
-        date = None
-        screenPos = None
-        shift = None
-        for index in xrange(len(info)):
-            action = info[index]
-            if action == "": continue
-            if index == 0: #datetime
-                date = datetime.datetime.strptime(action, "%Y %m %d %H %M")
-                continue
-            elif index == 1: #screenPos and shift
-                action = action.split(".")
-                screenPos = (int(action[0]), int(action[1]))
-                shift = int(action[2])
-                city = action[3]
-                if city == "Pittsburgh": city = self.pgh
-                else: city = ephem.city(city)
-                city.date = date
+        (view, saved) = readDrawing(os.path.join(directory, source),
+                                    self.catalog)
+        self.date = view.date
+        self.screenPos = view.screenPos
+        self.shift = view.shift
+        #lines only need their stars' rows; positions for the saved sky are
+        #worked out when it's next drawn
+        self.setCity(view.cityName)
+        self.updateOptionButtons()
+        self.resetDrawing()
+        drawn = { } #edge -> lines along it, so an erase finds one in O(1)
+        for (typeof, star1, star2) in saved:
+            line = Line(star1, self.screenPos)
+            line.setEnd(star2)
+            if typeof == "erase":
+                #replayed, so erased lines don't come back
+                if len(drawn.get(line.edge(), [ ])) > 0:
+                    self.removeLine(drawn[line.edge()].pop())
                 continue
-            action = action.split(".")
-            typeof = action[0]
-            line = action[1]
-            line = line.split("|")
-            (star1Name, star2Name) = (line[0], line[1])
-            (star1, star2) = (None, None)
-            for star in self.starList:
-                if star.name == star1Name:
-                    star1 = star
-                elif star.name == star2Name:
-                    star2 = star
-            star1.calculate(city, shift)
-            star2.calculate(city, shift)
-            newLine = Line(star1, screenPos)
-            newLine.setEnd(star2, screenPos)
-            lines += [ newLine ]
-            actions += [ (typeof, lines[-1]) ]
-        self.date = date
-        self.screenPos = screenPos
-        self.shift = shift
-        self.lines = copy.copy(lines)
-        self.actions = copy.copy(actions)
+            self.addLine(line)
+            drawn.setdefault(line.edge(), [ ]).append(line)
 
     def loadConstellation(self, const):
+        #figures were all read at startup, and the view is left alone
         self.const = const
-        folder = "const" #where all constellations are
-        self.unpackFile(const+".txt", folder)
-        self.constLines = copy.copy(self.lines)
-        #create set of stars in constellation
-        self.constStars = set()
-        for line in self.constLines:
-            self.constStars.add(line.star1)
-            self.constStars.add(line.star2)
-        self.lines = [ ]
-        self.actions = [ ]
+        self.figure = self.figures[const]
+        self.resetDrawing()
+        self.graph.setFigure(self.figure)
+
+    #finished lines only go in and out of self.lines through these, so the
+    #drawing graph always matches them
+    def addLine(self, line):
+        if line in self.lines: return
+        self.lines.add(line)
+        self.graph.add(line.edge())
+        self.indexLine(line)
+
+    def removeLine(self, line):
+        if line not in self.lines: return
+        self.lines.remove(line)
+        self.graph.remove(line.edge())
+        self.lineIndex.remove(line)
+
+    def resetDrawing(self):
+        #no lines and nothing to undo
+        self.lines.clear()
+        self.graph.clear()
+        self.lineIndex.clear()
+        self.history.clear()
+        (self.onLine, self.newLine) = (False, None)
+
+    def finishLine(self, star):
+        #ends the line being drawn at star
+        line = self.newLine
+        line.setEnd(star)
+        self.addLine(line)
+        self.history.record("draw", line)
+        (self.onLine, self.newLine) = (False, None)
+        if self.mode == "quiz" and self.graph.solved():
+            #no need to wait for the hint button
+            self.hint.setText(self.checkAnswer())
+            self.hint.display()
+
+    def nextQuiz(self, start):
+        #index of the first figure from start that is above the horizon
+        for index in range(start, len(self.quizzes)):
+            if self.figures[self.quizzes[index]].visible(self.catalog):
+                return index
+        return max(start, len(self.quizzes))
 
 
 ################################ UPDATE FUNCTIONS #############################
 
 
-    def calculateStars(self):
-        for star in self.starList:
-            star.calculate(self.city, self.shift)
+    def calculateStars(self, city=None):
+        #does nothing unless the date, city or zoom changed since last time
+        if city == None:
+            if not self.skyCache.dirty: return
+            self.updateCity()
+            city = self.city
+        #stars too faint for this zoom aren't computed at all
+        self.catalog.setLimit(self.levelOfDetail.at(self.shift)[0])
+        self.skyCache.update(city, self.shift)
+
+    def buildLabelIndex(self, placements):
+        #labels are placed for the view, so their boxes are moved onto the
+        #big screen like the dots
+        (left, up) = self.screenPos
+        self.labelIndex.build([(i, labelLeft+left, labelTop+up,
+                                labelRight+left, labelBot+up)
+                for (i, (labelLeft, labelTop, labelRight, labelBot))
+                in placements.items()])
+        self.labelIndexPlacements = placements
+
+    def indexLine(self, line):
+        if self.lineIndexView != (self.skyCache.key, self.catalog.shift):
+            self.lineIndexView = None #rebuilt by the next lineAt
+            return
+        #lines to stars below the horizon can't be clicked on
+        (start, end) = (line.star1.screenPos, line.star2.screenPos)
+        if start == None or end == None: return
+        self.lineIndex.add(line, start[0], start[1], end[0], end[1])
+
+    def lineAt(self, x, y):
+        #the line nearest display point (x, y), None if none is close; the
+        #index is only rebuilt when the sky itself has moved, not on panning
+        self.calculateStars()
+        view = (self.skyCache.key, self.catalog.shift)
+        if view != self.lineIndexView:
+            self.lineIndex.clear()
+            self.lineIndexView = view
+            for line in self.lines: self.indexLine(line)
+        (left, up) = self.screenPos
+        return self.lineIndex.nearest(x+left, y+up)
+
+    def starsAt(self, x, y):
+        #stars whose dot or label may cover display point (x, y), in the
+        #same order as the catalog
+        self.calculateStars()
+        catalog = self.catalog
+        (left, up) = self.screenPos
+        (x, y) = (x+left, y+up)
+        reach = self.dotReach
+        stars = catalog.viewport(x-reach, y-reach, x+reach, y+reach)
+        (xs, ys) = catalog.screenPoints(stars)
+        r = numpy.abs(catalog.r[stars]) + 1
+        found = set(stars[(abs(xs-x) <= r) & (abs(ys-y) <= r)].tolist())
+        placements = self.labelPlacements()
+        if placements is not self.labelIndexPlacements:
+            self.buildLabelIndex(placements)
+        found.update(self.labelIndex.query(x, y))
+        return [catalog[i] for i in sorted(found)]
 
     def updateScreenPos(self, shiftChange, x=0, y=0):
         (oldX, oldY) = self.screenPos
@@ -648,6 +715,7 @@ class Planetarium(Framework):
         else:
             oldShift = self.shift
             self.shift += shiftChange
+            self.skyCache.invalidate()
             self.screenPos=(oldX*self.shift/oldShift, oldY*self.shift/oldShift)
 
     def updateDate(self):
@@ -667,7 +735,17 @@ class Planetarium(Framework):
                 hr = button.getTime()
             elif button.name == "minute":
                 mi = button.getTime()
-        self.date = self.date.replace(yr, mon, day, hr, mi)
+        date = self.date.replace(yr, mon, day, hr, mi)
+        if date != self.date:
+            self.date = date
+            self.skyCache.invalidate()
+
+    def setCity(self, name):
+        #name is "Pittsburgh" or one of PyEphem's cities
+        if name == "Pittsburgh": self.city = self.pgh
+        else: self.city = ephem.city(name)
+        self.cityName = name
+        self.skyCache.invalidate()
 
     def updateCity(self):
         self.city.date = ephem.Date(self.date)
@@ -696,6 +774,7 @@ class Planetarium(Framework):
     def resetDrawMode(self):
         self.date = datetime.datetime.now()
         self.city = self.pgh
+        self.skyCache.invalidate()
         self.screenPos = (self.shift-self.width//2, self.shift-self.height//2)
 
 
@@ -703,39 +782,30 @@ class Planetarium(Framework):
 
 
     def checkAnswer(self):
-        lines = set(self.lines) #gets rid of duplicates
-        constLines = set(self.constLines)
-        stars = set()
-        for line in self.lines:
-            stars.add(line.star1)
-            stars.add(line.star2)
-        diff = len(self.constStars) - len(stars)
-        linediff = len(constLines) - len(lines)
-        if diff > 0 or (diff==0 and stars!=self.constStars): 
-            #not enough stars! find missing star
-            missingStars = self.constStars - stars
-            #get stars in constellation but not in drawing
-            hintStar = missingStars.pop()
-            hinttext = "Hint: You are missing " + str(hintStar)
-        elif diff < 0: #too many stars! find the extra star
-            extraStars = stars - self.constStars
-            #get stars in drawing that arent in constellation
-            hintStar = extraStars.pop()
-            hinttext = "Hint: "+str(hintStar)+" does not belong!"
-        elif linediff < 0 or (linediff==0 and lines!=constLines):
+        #the drawing graph already knows how it differs from the figure, so
+        #this is the same work however many lines there are; rows make
+        #aliases, duplicate rows and lines drawn either way round all match
+        graph = self.graph
+        names = self.catalog.names
+        (missingStars, extraStars) = (graph.missingStars, graph.extraStars)
+        (missingLines, wrongLines) = (graph.missingEdges, graph.extraEdges)
+        if len(missingStars) > 0 and len(missingStars) >= len(extraStars):
+            #not enough stars! the brightest missing one is the hint
+            hintStar = min(missingStars)
+            hinttext = "Hint: You are missing " + names[hintStar]
+        elif len(extraStars) > 0: #too many stars! any extra one will do
+            hintStar = next(iter(extraStars))
+            hinttext = "Hint: "+names[hintStar]+" does not belong!"
+        elif len(wrongLines) > 0 and len(wrongLines) >= len(missingLines):
             #too many lines/lines where they shouldn't belong
-            wrongLines = lines - constLines
-            #get the lines in drawing not in constellations
-            hintLine = wrongLines.pop()
-            hinttext = ("Hint: " +hintLine.star1.name+" and "+
-                    hintLine.star2.name+" shouldn't be connected!")
-        elif linediff > 0:
+            (star1, star2) = next(iter(wrongLines))
+            hinttext = ("Hint: " +names[star1]+" and "+
+                    names[star2]+" shouldn't be connected!")
+        elif len(missingLines) > 0:
             #not enough lines! find the missing line
-            missingLines = constLines - lines
-            hintLine = missingLines.pop()
-            star1, star2 = hintLine.star1, hintLine.star2
-            hinttext = ("Hint: " +str(star1)+" and "+str(star2)+" should be" 
-                                                        +" connected!")
+            (star1, star2) = min(missingLines)
+            hinttext = ("Hint: " +names[star1]+" and "+names[star2]+
+                                                    " should be connected!")
         else:
             hinttext = self.correctMsg
         return hinttext
@@ -752,9 +822,19 @@ class Planetarium(Framework):
             if isinstance(button, ModeButton):
                 self.lastMode = self.mode
                 if self.mode == "draw" and button.name == "quiz":
-                    self.loadConstellation(self.quizzes[0])
-                    self.mode = button.name
+                    #starts at the first figure that's up; with none up
+                    #there's nothing to draw, so it stays in draw mode
+                    first = self.nextQuiz(0)
+                    if first >= len(self.quizzes):
+                        self.hint.setText("No constellation is up now!")
+                        self.hint.display()
+                    else:
+                        self.hint.display(False)
+                        self.constindex = first
+                        self.loadConstellation(self.quizzes[first])
+                        self.mode = button.name
                 elif self.mode == "quiz" and button.name == "quiz":
+                    self.hint.display(False)
                     self.mode = "draw"
                 else:
                     self.mode = button.name
@@ -766,40 +846,35 @@ class Planetarium(Framework):
                     self.selectedDrawButton = None
                 return 1
             elif button.name == "undo":
-                if self.actions != [ ]:
-                    toUndo = self.actions.pop()
-                    self.undidActions.append(toUndo)
+                toUndo = self.history.undo()
+                if toUndo != None:
                     (action, line) = toUndo
                     if action == "erase":
-                        self.lines.append(line)
+                        self.addLine(line)
                     elif action == "draw":
-                        self.lines.remove(line)
+                        self.removeLine(line)
                 return 1
             elif button.name == "redo":
-                if self.undidActions != [ ]:
-                    toRedo = self.undidActions.pop()
-                    self.actions.append(toRedo)
+                toRedo = self.history.redo()
+                if toRedo != None:
                     (action, line) = toRedo
                     if action == "erase":
-                        self.lines.remove(line)
+                        self.removeLine(line)
                     elif action == "draw":
-                        self.lines.append(line)
+                        self.addLine(line)
                 return 1
             elif button.name == "clear":
-                self.lines = [ ] 
-                self.actions = [ ] 
+                self.resetDrawing()
             elif button.name == "save":
                 pygame.image.save(self.screen, "screenshot.jpg")
                 return 1
             elif button.name == "savefile":
-                (left, up) = self.screenPos
-                data = (self.date.strftime("%Y %m %d %H %M")+"\n"+str(int(left))
-                        +"."+str(int(up))+"."+str(self.shift)+"." + 
-                        self.cityName + "\n")
-                for action in self.actions:
-                    (typeof, line) = action
-                    data += typeof + "."+ str(line)+"\n"
-                writeFile("savedata.txt", data)
+                view = View(self.date, self.screenPos, self.shift,
+                            self.cityName)
+                #the lines on screen; undo history isn't saved
+                writeDrawing("savedata.txt", view,
+                             (("draw", line.star1, line.star2)
+                              for line in self.lines), self.catalog)
                 print "File saved successfully to savedata.txt!" #TODO popup?
             elif button.name == "loadfile":
                 try:
@@ -814,65 +889,48 @@ class Planetarium(Framework):
 
     def checkLines(self, x, y):
         if self.drawMode == "erase":
-            erasedLine = None
-            for line in self.lines: #FLAG error here
-                if line.onClick(x, y):
-                    erasedLine = line
-                    self.lastAction = "erase"
+            erasedLine = self.lineAt(x, y)
             if erasedLine != None: 
-                self.actions.append(("erase", erasedLine))
-                self.erasedLines.append(erasedLine)
-                self.lines.remove(erasedLine)
-                erasedLine = None
+                self.history.record("erase", erasedLine)
+                self.removeLine(erasedLine)
 
     def checkStarsDrawMode(self, x, y):
+        self.calculateStars()
         (left, up) = self.screenPos
         if self.drawMode == "draw":
-            for star in self.starList:
-                if star.displayPos(left,up) == None: continue #not on screen
+            for star in self.starsAt(x, y):
                 (cx, cy) = star.displayPos(left,up)
-                (width, height) = self.smallFont.size(star.name)
                 if pointInCircle((x,y), (cx, cy), star.r):
                     self.selectedDrawButton = None
                     if self.onLine == False:
-                        self.lines.append(Line(star, self.screenPos))
+                        self.newLine = Line(star, self.screenPos)
                         self.onLine = True
-                    else: #is on a line
-                        if star != self.lines[-1].star1 and self.lines!=[]:
-                            self.lines[-1].setEnd(star, self.screenPos)
-                            self.actions.append(("draw", self.lines[-1]))
-                        elif self.lines!=[]:
-                            self.lines.pop(-1)
-                        self.onLine = False
+                    elif star != self.newLine.star1:
+                        self.finishLine(star)
+                    else: #back on its first star: drop it
+                        (self.onLine, self.newLine) = (False, None)
                     return 1
             check = self.checkStarLabelsDrawMode(x, y)  
             if check == 1: return 1
             if self.onLine and self.selectedDrawButton==None: 
-                if self.lines != [ ]: self.lines.pop()
-                self.onLine = False
+                (self.onLine, self.newLine) = (False, None)
                 return 1   
 
     def checkStarLabelsDrawMode(self, x, y):
+        self.calculateStars()
         (left, up) = self.screenPos
         if self.drawMode == "draw":
-            for star in self.starList:
-                if star.displayPos(left,up) == None: continue #not on screen
-                (cx, cy) = star.displayPos(left,up)
-                (width, height) = self.smallFont.size(star.name)
-                if pointInBox((x,y),(cx, cy, cx+width, cy+height)):
+            for star in self.starsAt(x, y):
+                if self.onStarLabel(star, x, y):
                     self.selectedDrawButton = None
                     if self.onLine == False:
-                        self.lines.append(Line(star, self.screenPos))
+                        self.newLine = Line(star, self.screenPos)
                         self.onLine = True
-                        return 1
-                    else: #is on a line
-                        if star != self.lines[-1].star1:
-                            self.lines[-1].setEnd(star, self.screenPos)
-                            self.actions.append(("draw", self.lines[-1]))
-                        else:
-                            self.lines.pop(-1)
-                        self.onLine = False
-                        return 1
+                    elif star != self.newLine.star1:
+                        self.finishLine(star)
+                    else: #back on its first star: drop it
+                        (self.onLine, self.newLine) = (False, None)
+                    return 1
 
     def optionsMousePressed(self, x, y):
         (left, up) = self.screenPos
@@ -883,6 +941,7 @@ class Planetarium(Framework):
                     self.inRealTime = val
                 elif isinstance(button, NowButton):
                     self.date = val
+                    self.skyCache.invalidate()
                     self.updateOptionButtons()
                 elif isinstance(button, ModeButton):
                     if val == "return":
@@ -893,13 +952,12 @@ class Planetarium(Framework):
                     self.selectedButton = val
 
     def checkStars(self, x, y):
+        self.calculateStars()
         (left, up) = self.screenPos
-        for star in self.starList:
-            if star.displayPos(left,up) == None: continue #not on screen
+        for star in self.starsAt(x, y):
             (cx, cy) = star.displayPos(left,up)
-            (width, height) = self.smallFont.size(star.name)
             if (pointInCircle((x,y), (cx, cy), star.r)
-                        or pointInBox((x,y), (cx, cy, cx+width, cy+height))):
+                        or self.onStarLabel(star, x, y)):
                 self.infostar = star
                 return #ensures only one star info shown
         self.infostar = None
@@ -952,11 +1010,12 @@ class Planetarium(Framework):
         clicked = self.hint.onClick(x, y)
         if (clicked and (self.hint.text == "Correct!" or 
                     self.hint.text == "You have completed the quiz!")):
-            self.constindex+=1
+            #figures below the horizon can't be drawn, so they're skipped
+            self.constindex = self.nextQuiz(self.constindex+1)
             self.hint.text = ""
             if self.constindex == len(self.quizzes):
                 self.hint.setText("You have completed the quiz!")
-                self.lines = [ ]
+                self.resetDrawing()
                 self.hint.display(True)
             elif self.constindex > len(self.quizzes):
                 self.hint.setText("")
@@ -985,6 +1044,8 @@ class Planetarium(Framework):
             if self.mode == "quiz": 
                 self.checkHint(x, y)
                 self.checkQuizButtons(x, y)
+            else: #only ever the "none up" note here; a click closes it
+                self.hint.onClick(x, y)
             check = self.checkDrawButtons(x, y)
             if check == 1: return 
             #check the nav buttons
@@ -1006,10 +1067,11 @@ class Planetarium(Framework):
         self.justClicked = False
 
     def mouseMotion(self, x, y):
+        if self.mode == "main" and self.hoverInfo:
+            self.checkStars(x, y)
         if self.onLine:
             #shows line drawing in real time
-            if self.lines != [ ]:
-                self.lines[-1].updateEndPoint(x, y)
+            self.newLine.updateEndPoint(x, y)
 
     def mouseDrag(self, x, y):
         if self.mode == "main" or self.mode == "draw" or self.mode == "quiz":
@@ -1032,13 +1094,7 @@ class Planetarium(Framework):
                 val = self.selectedButton.up()
             elif keyCode == pygame.K_DOWN:
                 val = self.selectedButton.down()
-            if val != None: 
-                if val == "Pittsburgh": 
-                    self.city = self.pgh
-                    self.cityName = val
-                else: 
-                    self.city = ephem.city(val)
-                    self.cityName = val
+            if val != None: self.setCity(val)
 
     def keyReleased(self, keyCode, modifier):
         pass
@@ -1048,36 +1104,40 @@ class Planetarium(Framework):
         return self._keys.get(key, False)
 
     def mouseScrollUp(self, x, y):
+        self.lastZoom = time.time()
         self.updateScreenPos(min(self.shiftChange, self.maxZoom-self.shift))
 
     def mouseScrollDown(self, x, y):
+        self.lastZoom = time.time()
         if self.shift-self.shiftChange < self.minZoom:
             pass
         else:
             self.updateScreenPos(-self.shiftChange)
 
+    def isAnimating(self):
+        #full frame rate only while something is moving on its own or the
+        #user is dragging/zooming; otherwise Framework waits for events
+        zooming = time.time() - self.lastZoom < self.zoomSettle
+        return (self.inFastTime or self.inRealTime or self.justClicked
+                or zooming or self.mode == "quit")
+
     def timerFired(self, dt):
         if self.mode == "quit":
+            self.closeCatalog()
             pygame.quit()
 
+        #while time is playing, stars are only rotated by the sidereal time
+        #and fully recomputed every self.catalog.maxStep days
+        self.catalog.incremental = self.inFastTime or self.inRealTime
+        self.skyCache.advancing = self.catalog.incremental
         if self.inFastTime:
-            newMinute = self.date.minute+1
-            newHour = self.date.hour
-            if self.date.minute+1 >= 60: 
-                newMinute = (self.date.minute+1)%60
-                newHour = self.date.hour+1
-            self.date = self.date.replace(self.date.year, self.date.month, 
-                            self.date.day, newHour%23, newMinute)
-            self.updateCity()
+            self.date += datetime.timedelta(minutes=self.fastTimeStep)
+            self.skyCache.invalidate()
 
         elif self.inRealTime:
             self.date = datetime.datetime.now()
-            self.updateCity()
+            self.skyCache.invalidate()
 
-        if self.mode == "draw" or self.mode == "quiz":
-            for line in self.lines:
-                if line.star2 != None:
-                    line.updateLine(self.screenPos) 
 
         if self.mode == "options":
             if self.inRealTime == True:
@@ -1092,14 +1152,35 @@ class Planetarium(Framework):
                 if self.selectedButton != None:
                     self.updateDate() 
 
-        self.updateCity()
         self.calculateStars()
 
 
+
 ######################## REDRAW FUNCTIONS ######################################
 
 
+    def layered(self):
+        return self.mode == "main" or self.mode == "draw" or self.mode == "quiz"
+
+    def backgroundChanged(self):
+        #the star layer is reused until the sky or the view moves
+        self.calculateStars()
+        key = (self.mode, self.skyCache.state, self.catalog.shift,
+                                        self.screenPos, self.lines.version)
+        changed = key != self.starLayerKey
+        self.starLayerKey = key
+        return changed
+
+    def redrawBackground(self, surface):
+        self.drawStars(surface)
+        if self.mode == "draw" or self.mode == "quiz":
+            self.drawLines(surface) #finished lines only change with the sky
+
     def redrawAll(self, screen):
+        #in main, draw and quiz mode the stars are already on the background
+        #layer; returns the areas drawn over it
+        self.screen = screen
+        rects = None
         if self.mode == "splash":
             self.drawSplash(screen)
         elif self.mode == "options":
@@ -1107,30 +1188,27 @@ class Planetarium(Framework):
         elif self.mode == "help":
             self.drawHelp(screen)
         elif self.mode == "main":
-            self.drawStars(screen)
-            self.drawButtons(screen)
+            rects = self.drawButtons(screen)
         elif self.mode == "draw":
-            self.drawStars(screen)
-            self.drawLines(screen)
-            self.drawButtons(screen)
-            self.drawDrawButtons(screen)
+            rects = (self.drawNewLine(screen) + self.drawButtons(screen) +
+                     self.drawDrawButtons(screen) +
+                     [self.hint.draw(screen, self.smallFont, self.glyphs)])
         elif self.mode == "quiz":
-            self.drawStars(screen)
-            self.drawLines(screen)
-            self.drawButtons(screen)
-            self.drawDrawButtons(screen)
-            self.drawQuiz(screen)
-        self.screen = screen
+            rects = (self.drawNewLine(screen) + self.drawButtons(screen) +
+                     self.drawDrawButtons(screen) + self.drawQuiz(screen))
+        if rects != None:
+            rects += self.drawInfo(screen)
+        return rects
 
     def drawSplash(self, screen):
         self.drawStars(screen, False)
         screen.blit(self.splashScreen, (0, 0))
         for button in self.splashButtons:
-            button.draw(screen, self.bigFont)
+            button.draw(screen, self.bigFont, self.glyphs)
 
     def drawOptions(self, screen):
         word = "OPTIONS"
-        (fx, fy) = self.font.size("OPTIONS")
+        (fx, fy) = self.glyphs.size(self.font, "OPTIONS")
         x = self.width//2-fx//2
         y = self.height*1//8
         self.drawText(screen, word, x, y, self.font, self.WHITE)
@@ -1153,97 +1231,181 @@ class Planetarium(Framework):
 
         self.resetTimeButtonColors()
         for button in self.optionsButtons:
-            button.draw(screen, self.font)
+            button.draw(screen, self.font, self.glyphs)
 
     def drawText(self, screen, word, x, y, font, color):
-        text = font.render(word, 1, color)
+        text = self.glyphs.render(font, word, color)
         screen.blit(text, (x, y))
 
-    def drawLines(self, screen):
-        for line in self.lines:
-            line.draw(screen, self.screenPos)
+    def drawLines(self, surface):
+        #every finished line, onto the background layer; both ends of all of
+        #them are looked up in one step, and lines to stars that have set
+        #are left out
+        pairs = self.lines.pairs()
+        if len(pairs) == 0: return
+        catalog = self.catalog
+        (left, up) = self.screenPos
+        pairs = pairs[catalog.isVisible(pairs[:, 0]) &
+                      catalog.isVisible(pairs[:, 1])]
+        (x1, y1) = catalog.screenPoints(pairs[:, 0])
+        (x2, y2) = catalog.screenPoints(pairs[:, 1])
+        ends = numpy.column_stack((x1-left, y1-up, x2-left, y2-up))
+        (color, width) = (self.WHITE, 2) #what Line draws with
+        for (startX, startY, endX, endY) in ends.astype(int).tolist():
+            pygame.draw.line(surface, color, (startX, startY), (endX, endY),
+                                                                    width)
+
+    def drawNewLine(self, screen):
+        if self.newLine == None: return [ ]
+        return [ self.newLine.draw(screen, self.screenPos) ]
 
     def drawButtons(self, screen):
+        rects = [ ]
         for button in self.buttons:
             if isinstance(button, ModeButton):
                 if button.name == self.mode:
                     button.color = self.GREEN
-                button.draw(screen, self.font)
+                rects.append(button.draw(screen, self.font, self.glyphs))
             else:
-                button.draw(screen, self.bigFont)
+                rects.append(button.draw(screen, self.bigFont, self.glyphs))
+        return rects
+
+    def starsOnScreen(self):
+        #(star indices, display xs, display ys) of the stars to draw
+        (left, up) = self.screenPos
+        catalog = self.catalog
+        #only stars in sky cells under the screen, above the horizon and
+        #bright enough for this zoom (see calculateStars) are looked at
+        stars = catalog.viewport(left-1, up-1, left+self.width+1,
+                                 up+self.height+1)
+        stars = stars[catalog.r[stars] >= 0]
+        #display positions for those at once, truncated like displayPos
+        (xs, ys) = catalog.screenPoints(stars)
+        xs = (xs - left).astype(int)
+        ys = (ys - up).astype(int)
+        onScreen = ((xs >= 0) & (xs <= self.width) &
+                    (ys >= 0) & (ys <= self.height))
+        return (stars[onScreen], xs[onScreen], ys[onScreen])
+
+    def labelPlacements(self):
+        #{star index: display (left, top, right, bottom) of its label}; the
+        #brightest stars are placed first, up to this zoom's budget, and
+        #none overlap.  Reused until the view changes.
+        self.calculateStars()
+        budget = self.levelOfDetail.at(self.shift)[1]
+        key = (self.skyCache.key, self.catalog.limit, self.shift,
+               self.screenPos, budget)
+        placements = self.labelPlacer.cached(key)
+        if placements != None: return placements
+        catalog = self.catalog
+        (stars, xs, ys) = self.starsOnScreen()
+        brightest = numpy.argsort(catalog.mag[stars], kind="mergesort")
+        labels = [ ]
+        for j in brightest[:self.labelCandidates*budget].tolist():
+            i = int(stars[j])
+            (width, height) = self.glyphs.size(self.smallFont,
+                                               catalog.names[i])
+            labels.append((i, int(xs[j]), int(ys[j]), width, height))
+        return self.labelPlacer.place(key, labels, self.width, self.height,
+                                                                    budget)
+
+    def onStarLabel(self, star, x, y):
+        box = self.labelPlacements().get(star.index)
+        return box != None and pointInBox((x, y), box)
 
     def drawStars(self, screen, drawNames=True):
+        #positions were found in timerFired; only redone if zoom changed since
+        self.calculateStars()
+        catalog = self.catalog
+        (stars, xs, ys) = self.starsOnScreen()
+        for (i, x, y) in zip(stars.tolist(), xs.tolist(), ys.tolist()):
+            pygame.draw.circle(screen, self.WHITE, (x, y), int(catalog.r[i]))
+        if drawNames:
+            for (i, box) in self.labelPlacements().items():
+                label = self.glyphs.render(self.smallFont, catalog.names[i],
+                                                                self.GREEN)
+                screen.blit(label, box[:2])
+
+    def drawInfo(self, screen):
+        if self.infostar == None: return [ ]
         (left, up) = self.screenPos
-        for star in self.starList:
-            star.calculate(self.city, self.shift)
-            
-            pos = star.displayPos(left, up)
-            if pos != None:
-                if pointInBox(pos, (0,0,self.width,self.height)):
-                    if star.r < 0: continue
-                    pygame.draw.circle(screen, self.WHITE, pos, star.r)
-                    if drawNames:
-                        label = self.smallFont.render(star.name, 1, self.GREEN)
-                        screen.blit(label, pos)
-        if self.infostar == None: return        
-        self.drawStarInfo(self.infostar, screen, self.infostar.displayPos(left, up))
+        pos = self.infostar.displayPos(left, up)
+        if pos == None: return [ ] #has set below the horizon
+        return [ self.drawStarInfo(self.infostar, screen, pos) ]
 
     def drawStarInfo(self, star, screen, pos):
         (x, y) = pos
-        starObj = star.body 
+        starObj = star.details(self.city)
         # RA will be the longest line
-        (width, height) = self.smallFont.size(
+        (width, height) = self.glyphs.size(self.smallFont,
                                     "Right Ascension: " + str(starObj.a_ra))
         fontHeight = height
-        pygame.draw.rect(screen, self.BLACK, 
+        rect = pygame.draw.rect(screen, self.BLACK, 
                             pygame.Rect(x, y+fontHeight, width, height*4 + 8))
 
         # Magnitude
-        mag = self.smallFont.render("Magnitude: " + str(starObj.mag), 1, 
-                                                                self.WHITE)
-        screen.blit(mag, (x, y+height+2))
+        mag = self.glyphs.render(self.smallFont,
+                            "Magnitude: " + str(starObj.mag), self.WHITE)
+        rect = rect.union(screen.blit(mag, (x, y+height+2)))
         # RA
-        ra=self.smallFont.render("Right Ascension: "+str(starObj.a_ra),1,
-                                                                    self.WHITE)
-        screen.blit(ra, (x, y+2*height+2))
+        ra = self.glyphs.render(self.smallFont,
+                            "Right Ascension: "+str(starObj.a_ra), self.WHITE)
+        rect = rect.union(screen.blit(ra, (x, y+2*height+2)))
         # Dec
-        dec = self.smallFont.render("Declination: "+str(starObj.dec), 1, 
-                                                                    self.WHITE)
-        screen.blit(dec, (x, y+3*height+2))
+        dec = self.glyphs.render(self.smallFont,
+                            "Declination: "+str(starObj.dec), self.WHITE)
+        rect = rect.union(screen.blit(dec, (x, y+3*height+2)))
         # Constellation - ephem.constellation(obj)[1] returns the name of
         # the constellation the star is within
-        const = self.smallFont.render("Constellation: " +
-                        ephem.constellation(starObj)[1], 1, self.WHITE)
-        screen.blit(const, (x, y+4*height+2))
+        const = self.glyphs.render(self.smallFont, "Constellation: " +
+                        ephem.constellation(starObj)[1], self.WHITE)
+        return rect.union(screen.blit(const, (x, y+4*height+2)))
 
     def drawDrawButtons(self, screen):
+        rects = [ ]
         for button in self.drawModeButtons:
             font = self.font
             if self.drawMode == "erase" and button.name == "erase":
-                button.drawSelected(screen)
+                rects.append(button.drawSelected(screen))
             if button.name == "quiz":
                 font = self.bigFont
                 if self.mode == "quiz": button.color = self.GREEN
                 else: button.color = self.PINK
-            button.draw(screen, font)
+            rects.append(button.draw(screen, font, self.glyphs))
+        return rects
 
     def drawHelp(self, screen):
         screen.blit(self.helpScreen, (0,0))
         for button in self.helpButtons:
-            button.draw(screen, self.font)
+            button.draw(screen, self.font, self.glyphs)
 
     def drawQuiz(self, screen):
-        const=""
-        if self.const == "bigdipper":
-            const = "The Big Dipper!"
-        elif self.const == "littledipper":
-            const = "The Little Dipper!"
-        title = self.bigFont.render("Draw: " + const, 1, self.WHITE)
-        screen.blit(title, 
-                (self.width//2-50-self.bigFont.size("Draw: "+const)[0]//2, 0))
+        const = self.figure.name + "!"
+        title = self.glyphs.render(self.bigFont, "Draw: " + const, self.WHITE)
+        rects = [ screen.blit(title, (self.width//2-50-
+                    self.glyphs.size(self.bigFont, "Draw: "+const)[0]//2, 0)) ]
+        #live count of the figure's lines drawn so far, and of wrong ones
+        progress = "%d of %d lines" % (self.graph.matched(), len(self.figure))
+        if len(self.graph.extraEdges) > 0:
+            progress += ", %d wrong" % len(self.graph.extraEdges)
+        text = self.glyphs.render(self.smallFont, progress, self.WHITE)
+        rects.append(screen.blit(text, (self.width//2-50-
+                self.glyphs.size(self.smallFont, progress)[0]//2,
+                self.glyphs.size(self.bigFont, const)[1])))
         for button in self.quizButtons:
-            button.draw(screen, self.font)
-        self.hint.draw(screen, self.smallFont)
-
-
-Planetarium().run()
\ No newline at end of file
+            rects.append(button.draw(screen, self.font, self.glyphs))
+        rects.append(self.hint.draw(screen, self.smallFont, self.glyphs))
+        return rects
+
+
+if __name__ == "__main__":
+    #python planetarium.py [extra catalog.edb/.csv ...] [--processes N]
+    parser = argparse.ArgumentParser(description="PyPlanetarium")
+    parser.add_argument("catalogs", nargs="*",
+                        help="extra .edb/.csv catalogs")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes computing star positions for big "
+                        "catalogs (0 for one per core)")
+    args = parser.parse_args()
+    Planetarium(catalogs=args.catalogs,
+                processes=args.processes or None).run()
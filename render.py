@@ -0,0 +1,136 @@
+"""
+Rendering helpers for PyPlanetarium
+
+Font rasterization is the most expensive pygame call we make, and most of
+the text on screen (star names, button labels) never changes.  GlyphCache
+keeps rendered surfaces and text sizes around so each string is only
+rasterized once.
+
+LevelOfDetail decides how deep into the catalog each zoom level goes and how
+many labels it can afford, so a wide view of a big catalog isn't drawn star
+by star.  LabelPlacer then spends that budget on labels that can actually be
+read, skipping any that would land on top of another.
+"""
+import bisect
+import collections
+import math
+import numpy
+
+
+class GlyphCache(object):
+    #rendered text surfaces keyed on (text, font, color) and text sizes keyed
+    #on (text, font); both evict the least recently used entry when full
+    def __init__(self, size=4096):
+        self.maxSize = size
+        self.surfaces = collections.OrderedDict()
+        self.sizes = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def lookup(self, table, key):
+        #moves key to the most recently used end; None if missing
+        value = table.pop(key, None)
+        if value is not None:
+            table[key] = value
+        return value
+
+    def store(self, table, key, value):
+        table[key] = value
+        while len(table) > self.maxSize:
+            table.popitem(last=False)
+        return value
+
+    def render(self, font, text, color, antialias=1):
+        key = (text, font, color, antialias)
+        surface = self.lookup(self.surfaces, key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+        self.misses += 1
+        return self.store(self.surfaces, key,
+                                font.render(text, antialias, color))
+
+    def size(self, font, text):
+        key = (text, font)
+        size = self.lookup(self.sizes, key)
+        if size is None:
+            size = self.store(self.sizes, key, font.size(text))
+        return size
+
+    def warmUp(self, font, texts, color):
+        #render ahead of time, e.g. every star name at startup
+        for text in texts:
+            self.render(font, text, color)
+            self.size(font, text)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.sizes.clear()
+
+
+class LevelOfDetail(object):
+    #levels = [(shift, faintest magnitude, most labels), ...]; in between
+    #levels both are interpolated on log(shift), outside them the nearest
+    #level is used
+    def __init__(self, levels):
+        self.levels = sorted(levels)
+        self.shifts = [math.log(level[0]) for level in self.levels]
+
+    def at(self, shift):
+        #returns (limiting magnitude, label budget)
+        position = math.log(max(shift, 1))
+        i = bisect.bisect_right(self.shifts, position)
+        if i == 0: return self.levels[0][1:]
+        if i == len(self.levels): return self.levels[-1][1:]
+        (lo, hi) = (self.levels[i-1], self.levels[i])
+        t = (position - self.shifts[i-1])/(self.shifts[i] - self.shifts[i-1])
+        magnitude = lo[1] + t*(hi[1] - lo[1])
+        labels = int(round(lo[2] + t*(hi[2] - lo[2])))
+        return (magnitude, labels)
+
+
+class LabelPlacer(object):
+    #greedy placement: labels are offered brightest first, and each takes the
+    #first spot around its star (below right, above right, below left, above
+    #left) that doesn't overlap a label already placed.  Overlap is checked
+    #on an occupancy grid of cellSize pixel cells.  Placement stops once
+    #budget labels are down, and is reused while the key stays the same.
+    SPOTS = ((0, 0), (0, -1), (-1, 0), (-1, -1)) #in label widths/heights
+
+    def __init__(self, cellSize=4):
+        self.cellSize = cellSize
+        self.key = None
+        self.placements = { } #item -> (left, top, right, bottom)
+        self.reused = 0
+
+    def cached(self, key):
+        #the last placements if they were made for key, else None
+        if key is None or key != self.key: return None
+        self.reused += 1
+        return self.placements
+
+    def place(self, key, labels, width, height, budget):
+        #labels = [(item, x, y, labelWidth, labelHeight), ...] brightest
+        #first, x/y being the star; width/height the area being drawn on
+        size = self.cellSize
+        (cols, rows) = (int(width)//size + 1, int(height)//size + 1)
+        occupied = numpy.zeros((rows, cols), dtype=bool)
+        placements = { }
+        for (item, x, y, labelWidth, labelHeight) in labels:
+            if len(placements) >= budget: break
+            for (dx, dy) in self.SPOTS:
+                (left, top) = (x + dx*labelWidth, y + dy*labelHeight)
+                (right, bottom) = (left + labelWidth, top + labelHeight)
+                if right < 0 or bottom < 0 or left > width or top > height:
+                    continue #nobody would see it
+                (col0, row0) = (max(0, left//size), max(0, top//size))
+                (col1, row1) = (right//size + 1, bottom//size + 1)
+                if not occupied[row0:row1, col0:col1].any():
+                    occupied[row0:row1, col0:col1] = True
+                    placements[item] = (left, top, right, bottom)
+                    break
+        (self.key, self.placements) = (key, placements)
+        return placements
@@ -0,0 +1,524 @@
+from __future__ import division
+
+"""
+Vectorized sky computation for PyPlanetarium
+
+Instead of calling ephem's compute() once per star, the whole catalog is kept
+in numpy arrays and every star's alt/az and screen position is found in one
+pass per frame, in two stages:
+
+  compute(observer), once per observer and time:
+    J2000 position + proper motion -> precession/nutation -> aberration
+        -> hour angle (from ephem's sidereal time) -> alt/az -> refraction
+        -> x/y on the unit sphere
+  project(shift) and viewport(...), whenever the zoom or view changes:
+    a cap around the view is turned back into J2000 and looked up in a fixed
+    RA/Dec partition (SkyPartition); only stars in cells it touches get an
+    affine transform to "big" screen coordinates
+
+Over short time steps the only thing that really changes is the Earth's
+rotation.  In incremental mode the positions on the equator of date are kept
+and only rotated by the new sidereal time; the full chain is redone once
+maxStep days have passed or the estimated drift exceeds driftLimit.
+
+Precession is IAU 1976 (Lieske), nutation uses the four largest terms and
+aberration uses a low precision solar longitude (formulas from Meeus,
+Astronomical Algorithms, ch. 21-23).  Refraction follows the same formulas
+as libastro (refract.c) so results line up with PyEphem.
+
+checkAccuracy() compares the engine to PyEphem: every star above the horizon
+agrees to within TOLERANCE (10 arcseconds, about half a pixel at maximum
+zoom); above a couple of degrees of altitude the difference is ~1.5".  Run
+this file to check that for a spread of dates and latitudes:
+
+    $ python sky.py [catalog.edb ...]
+"""
+import math
+import collections
+import numpy
+import ephem
+from spatial import SkyPartition
+
+J2000 = 36525.0 #ephem.Date of J2000.0 (2000/1/1 12:00)
+ARCSEC = math.pi/(180*3600)
+MAS = ARCSEC/1000
+TOLERANCE = 10*ARCSEC #max difference from PyEphem, radians
+#points taken along each side of a view to find the sky cap around it, and
+#room left for refraction (up to 35'), aberration, nutation and proper motion
+CAP_SAMPLES = 32
+CAP_MARGIN = math.radians(1)
+#how fast positions on the equator of date change, mostly from aberration
+#(up to ~0.35"/day) and precession (~0.14"/day)
+DRIFT_PER_DAY = 0.5*ARCSEC
+CACHE_BYTES = 64 << 20 #past sky states SkyCache keeps, beyond the current one
+
+
+def rotX(angle):
+    (c, s) = (math.cos(angle), math.sin(angle))
+    return numpy.array([[1, 0, 0], [0, c, s], [0, -s, c]])
+
+def rotY(angle):
+    (c, s) = (math.cos(angle), math.sin(angle))
+    return numpy.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+def rotZ(angle):
+    (c, s) = (math.cos(angle), math.sin(angle))
+    return numpy.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+def centuries(date):
+    #Julian centuries since J2000 for an ephem.Date
+    return (float(date) - J2000)/36525
+
+def precessionMatrix(T):
+    #mean equator of J2000 -> mean equator of date
+    zeta = (2306.2181*T + 0.30188*T**2 + 0.017998*T**3)*ARCSEC
+    z = (2306.2181*T + 1.09468*T**2 + 0.018203*T**3)*ARCSEC
+    theta = (2004.3109*T - 0.42665*T**2 - 0.041833*T**3)*ARCSEC
+    return rotZ(-z).dot(rotY(theta)).dot(rotZ(-zeta))
+
+def obliquity(T):
+    return (84381.448 - 46.8150*T - 0.00059*T**2 + 0.001813*T**3)*ARCSEC
+
+def nutation(T):
+    #returns (dPsi, dEps) in radians
+    omega = math.radians(125.04452 - 1934.136261*T)
+    sunL = math.radians(280.4665 + 36000.7698*T)
+    moonL = math.radians(218.3165 + 481267.8813*T)
+    dPsi = (-17.20*math.sin(omega) - 1.32*math.sin(2*sunL)
+            - 0.23*math.sin(2*moonL) + 0.21*math.sin(2*omega))
+    dEps = (9.20*math.cos(omega) + 0.57*math.cos(2*sunL)
+            + 0.10*math.cos(2*moonL) - 0.09*math.cos(2*omega))
+    return (dPsi*ARCSEC, dEps*ARCSEC)
+
+def nutationMatrix(T):
+    #mean equator of date -> true equator of date
+    eps0 = obliquity(T)
+    (dPsi, dEps) = nutation(T)
+    return rotX(-(eps0+dEps)).dot(rotZ(-dPsi)).dot(rotX(eps0))
+
+def earthVelocity(T):
+    #Earth's velocity over c, equatorial coordinates of date
+    meanL = math.radians(280.46646 + 36000.76983*T)
+    anomaly = math.radians(357.52911 + 35999.05029*T)
+    center = math.radians(1.914602*math.sin(anomaly)
+                            + 0.019993*math.sin(2*anomaly))
+    sunLong = meanL + center
+    kappa = 20.49552*ARCSEC
+    eps = obliquity(T)
+    (vx, vy) = (kappa*math.sin(sunLong), -kappa*math.cos(sunLong))
+    return numpy.array([vx, vy*math.cos(eps), vy*math.sin(eps)])
+
+def refract(alt, pressure, temp):
+    #true -> apparent altitude, inverting libastro's unrefract()
+    if pressure == 0: return alt
+    apparent = alt.copy()
+    for i in range(4):
+        deg = numpy.degrees(apparent)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            high = 7.888888e-5*pressure/((273+temp)*numpy.tan(apparent))
+            low = numpy.radians(((2e-5*deg+1.96e-2)*deg+1.594e-1)*pressure/
+                                ((273+temp)*((8.45e-2*deg+5.05e-1)*deg+1)))
+        r = numpy.where(deg >= 15, high, low)
+        r = numpy.where(numpy.isfinite(r) & (r > 0), r, 0)
+        apparent = alt + r
+    return apparent
+
+def horizonAt(vectors, lst, lat):
+    #equatorial of date -> (alt, az), before refraction, for local sidereal
+    #time lst and latitude lat
+    (cosLst, sinLst) = (math.cos(lst), math.sin(lst))
+    (cosLat, sinLat) = (math.cos(lat), math.sin(lat))
+    (vx, vy, vz) = (vectors[:, 0], vectors[:, 1], vectors[:, 2])
+    #x toward the meridian, y toward the west
+    mx = vx*cosLst + vy*sinLst
+    my = vx*sinLst - vy*cosLst
+    north = cosLat*vz - sinLat*mx
+    east = -my
+    up = sinLat*vz + cosLat*mx
+    alt = numpy.arcsin(numpy.clip(up, -1, 1))
+    az = numpy.arctan2(east, north) % (2*math.pi)
+    return (alt, az)
+
+def spherePoints(alt, az):
+    #same sphere -> xy conversion as Star.calculate
+    cosAlt = numpy.cos(alt)
+    return (cosAlt*numpy.cos(az), -cosAlt*numpy.sin(az))
+
+
+class SkyState(object):
+    #the observer date and location a set of positions was computed for
+    #with a resolution (seconds), dates within the same step compare equal
+    def __init__(self, observer, resolution=0):
+        self.date = float(observer.date)
+        if resolution > 0:
+            self.date = int(math.floor(self.date*86400/resolution))
+        self.lat = float(observer.lat)
+        self.long = float(observer.long)
+
+    def key(self):
+        return (self.date, self.lat, self.long)
+
+    def __eq__(self, other):
+        return isinstance(other, SkyState) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+class SkyEngine(object):
+    #ra, dec in radians (J2000), pmRA (already times cos dec) and pmDec in
+    #milliarcseconds per year, as stored by ephem's FixedBody
+    def __init__(self, ra, dec, mag, pmRA=None, pmDec=None, epoch=J2000):
+        self.ra = numpy.asarray(ra, dtype=float)
+        self.dec = numpy.asarray(dec, dtype=float)
+        self.mag = numpy.asarray(mag, dtype=float)
+        n = len(self.ra)
+        if pmRA is None: pmRA = numpy.zeros(n)
+        if pmDec is None: pmDec = numpy.zeros(n)
+        self.pmRA = numpy.asarray(pmRA, dtype=float)
+        self.pmDec = numpy.asarray(pmDec, dtype=float)
+        self.epoch = numpy.resize(numpy.asarray(epoch, dtype=float), n)
+        self.hasMotion = bool(numpy.any(self.pmRA) or numpy.any(self.pmDec))
+        self.r = self.mag.astype(int) #truncates like int(body.mag)
+        self.vectors = self.unitVectors(self.ra, self.dec)
+        self.alt = self.az = None
+        self.x = self.y = None
+        self.visible = None
+        #stars by J2000 RA/Dec cell, built the first time a zoomed in view
+        #needs it; used unless a view covers more than partitionArea of the
+        #2x2 square around the sky disk
+        self.partition = SkyPartition()
+        self.partitionArea = 1.0
+        self.matrix = None #J2000 -> equator of date, from the last full pass
+        self.frame = None #(sidereal time, latitude, matrix) of compute()
+        self.shift = None
+        self.state = None #SkyState of the last compute()
+        self.active = n #only the first active stars are computed
+        self.limit = None #faintest magnitude shown, None for all
+        #incremental time stepping
+        self.incremental = False
+        self.maxStep = 1.0 #days between full recomputes
+        self.driftLimit = 2*ARCSEC
+        self.apparent = None #positions on the equator of date
+        self.apparentDate = None
+        self.fullComputes = 0
+        #a ParallelSky (parallel.py) to share compute() out over processes,
+        #None to always compute here
+        self.parallel = None
+        self.shared = False #alt/az/x/y are views of the pool's shared arrays
+
+    def __len__(self):
+        return len(self.ra)
+
+    @staticmethod
+    def fromBodies(bodies):
+        (ra, dec, mag, pmRA, pmDec, epoch) = ([ ], [ ], [ ], [ ], [ ], [ ])
+        for body in bodies:
+            try:
+                mag.append(body.mag)
+            except RuntimeError: #magnitude is undefined until first compute
+                body.compute()
+                mag.append(body.mag)
+            ra.append(float(body._ra))
+            dec.append(float(body._dec))
+            pmRA.append(body._pmra)
+            pmDec.append(body._pmdec)
+            epoch.append(float(body._epoch))
+        return SkyEngine(ra, dec, mag, pmRA, pmDec, epoch)
+
+    @staticmethod
+    def unitVectors(ra, dec):
+        cosDec = numpy.cos(dec)
+        return numpy.column_stack((cosDec*numpy.cos(ra),
+                                   cosDec*numpy.sin(ra), numpy.sin(dec)))
+
+    def setActive(self, count):
+        #limits computing to the first count stars; True if that changed
+        count = max(0, min(int(count), len(self)))
+        if count == self.active: return False
+        self.active = count
+        self.shift = None
+        return True
+
+    def meanPositions(self, date, start=0, end=None):
+        #J2000 unit vectors with proper motion applied up to date, for stars
+        #start to end (the active ones by default)
+        if end == None: end = self.active
+        rows = slice(start, end)
+        if not self.hasMotion: return self.vectors[rows]
+        (ra, dec) = (self.ra[rows], self.dec[rows])
+        years = (float(date) - self.epoch[rows])/365.25
+        dec = dec + self.pmDec[rows]*MAS*years
+        ra = ra + self.pmRA[rows]*MAS*years/numpy.cos(self.dec[rows])
+        return self.unitVectors(ra, dec)
+
+    def apparentPositions(self, date, start=0, end=None):
+        #unit vectors on the true equator and equinox of date
+        T = centuries(date)
+        matrix = nutationMatrix(T).dot(precessionMatrix(T))
+        self.matrix = matrix
+        vectors = self.meanPositions(date, start, end).dot(matrix.T)
+        vectors = vectors + earthVelocity(T)
+        vectors /= numpy.sqrt((vectors**2).sum(axis=1))[:, numpy.newaxis]
+        return vectors
+
+    def needsFullCompute(self, date):
+        if not self.incremental or self.apparent is None: return True
+        if len(self.apparent) < self.active: return True
+        step = abs(date - self.apparentDate)
+        return step > self.maxStep or step*DRIFT_PER_DAY > self.driftLimit
+
+    def horizon(self, vectors, observer):
+        #equatorial of date -> (alt, az), before refraction
+        return horizonAt(vectors, float(observer.sidereal_time()),
+                         float(observer.lat))
+
+    def compute(self, observer):
+        #alt/az and unit sphere x/y; call project() for screen positions
+        date = float(observer.date)
+        full = self.needsFullCompute(date)
+        parallel = (self.parallel != None and
+                    self.parallel.worthwhile(self.active))
+        #positions worked out in this process aren't in the workers' memory
+        if parallel and not self.parallel.holds(self.apparent): full = True
+        if parallel:
+            (self.alt, self.az, self.x, self.y) = self.parallel.compute(
+                                                        self, observer, full)
+            self.shared = True
+        else:
+            if full: self.apparent = self.apparentPositions(date)
+            #rotating by the observer's sidereal time is all that's left
+            (alt, az) = self.horizon(self.apparent[:self.active], observer)
+            self.alt = refract(alt, observer.pressure, observer.temp)
+            self.az = az
+            (self.x, self.y) = spherePoints(self.alt, self.az)
+            self.shared = False
+        if full:
+            self.apparentDate = date
+            self.fullComputes += 1
+        self.visible = self.alt >= 0
+        self.state = SkyState(observer)
+        self.frame = (float(observer.sidereal_time()), float(observer.lat),
+                      self.matrix)
+        self.shift = None #needs projecting again
+
+    def snapshot(self):
+        (alt, az, x, y) = (self.alt, self.az, self.x, self.y)
+        if self.shared: #the next parallel compute writes over these
+            (alt, az, x, y) = (alt.copy(), az.copy(), x.copy(), y.copy())
+        return (alt, az, x, y, self.visible, self.frame, self.state)
+
+    def restore(self, snapshot):
+        (self.alt, self.az, self.x, self.y, self.visible,
+                                    self.frame, self.state) = snapshot
+        self.shared = False
+        self.shift = None
+
+    def setMagnitudeLimit(self, magnitude):
+        if magnitude == self.limit: return False
+        self.limit = magnitude
+        self.shift = None #what's shown has changed
+        return True
+
+    def project(self, shift):
+        #positions are based on the "big" screen, not the "current" screen;
+        #they're only worked out for the stars asked for (see viewport)
+        self.shift = shift
+
+    def screenPoints(self, stars):
+        #"big" screen positions for an array of star indices
+        return (self.shift * (self.x[stars] + 1),
+                self.shift * (-self.y[stars] + 1))
+
+    def isVisible(self, stars):
+        #which of an array of star indices are above the horizon (and were
+        #computed at all)
+        stars = numpy.asarray(stars, dtype=int)
+        shown = numpy.zeros(len(stars), dtype=bool)
+        if self.visible is None or self.shift is None: return shown
+        inside = stars < len(self.visible)
+        shown[inside] = self.visible[stars[inside]]
+        return shown
+
+    def viewCap(self, x0, y0, x1, y1):
+        #a J2000 (center, angular radius) cap holding every direction above
+        #the horizon whose unit disk x/y falls inside the box
+        (lst, lat, matrix) = self.frame
+        #walk the edge of the box, pulling points outside the disk onto the
+        #horizon, and the part of the horizon inside the box
+        steps = numpy.linspace(0, 1, CAP_SAMPLES)
+        (dx, dy) = (x1 - x0, y1 - y0)
+        xs = numpy.concatenate((x0 + dx*steps, x1 + 0*steps,
+                                x1 - dx*steps, x0 + 0*steps))
+        ys = numpy.concatenate((y0 + 0*steps, y0 + dy*steps,
+                                y1 + 0*steps, y1 - dy*steps))
+        angles = numpy.linspace(0, 2*math.pi, 4*CAP_SAMPLES)
+        (hx, hy) = (numpy.cos(angles), numpy.sin(angles))
+        inBox = (hx >= x0) & (hx <= x1) & (hy >= y0) & (hy <= y1)
+        xs = numpy.concatenate((xs, hx[inBox]))
+        ys = numpy.concatenate((ys, hy[inBox]))
+        length = numpy.maximum(1, numpy.sqrt(xs**2 + ys**2))
+        (xs, ys) = (xs/length, ys/length)
+        #x/y are north and west, lifted back onto the sphere
+        points = numpy.column_stack((xs, -ys,
+                            numpy.sqrt(numpy.maximum(0, 1 - xs**2 - ys**2))))
+        center = points.mean(axis=0)
+        center /= numpy.sqrt((center**2).sum())
+        distance = numpy.arccos(numpy.clip(points.dot(center), -1, 1))
+        #the farthest point may lie between two samples
+        edge = points[:4*CAP_SAMPLES]
+        gap = numpy.sqrt((numpy.diff(edge, axis=0)**2).sum(axis=1)).max()
+        if inBox.any(): gap = max(gap, angles[1])
+        radius = distance.max() + gap + CAP_MARGIN
+        #north/east/up -> equator of date (undoing horizon()) -> J2000
+        (north, east, up) = center
+        (cosLat, sinLat) = (math.cos(lat), math.sin(lat))
+        mx = cosLat*up - sinLat*north
+        vz = sinLat*up + cosLat*north
+        my = -east
+        (cosLst, sinLst) = (math.cos(lst), math.sin(lst))
+        vector = numpy.array((mx*cosLst + my*sinLst,
+                              mx*sinLst - my*cosLst, vz))
+        if matrix is not None: vector = matrix.T.dot(vector)
+        return (vector, radius)
+
+    def viewport(self, left, up, right, bottom):
+        #indices of stars above the horizon and within the magnitude limit
+        #that may be inside the "big" screen box, in catalog order
+        shift = self.shift
+        (x0, y0) = (left/shift - 1, 1 - bottom/shift)
+        (x1, y1) = (right/shift - 1, 1 - up/shift)
+        covered = (max(0, min(x1, 1) - max(x0, -1)) *
+                   max(0, min(y1, 1) - max(y0, -1)))
+        if covered > self.partitionArea:
+            #most of the sky is on screen; sorting it into cells won't pay
+            stars = numpy.flatnonzero(self.visible)
+        else:
+            if not self.partition.built: self.partition.build(self.ra, self.dec)
+            (center, radius) = self.viewCap(x0, y0, x1, y1)
+            stars = self.partition.query(center, radius)
+            stars = stars[stars < self.active]
+            stars = stars[self.visible[stars]]
+        if self.limit is not None:
+            stars = stars[self.mag[stars] <= self.limit]
+        return stars
+
+
+class SkyCache(object):
+    #remembers computed positions by observer location and date (to the
+    #nearest resolution seconds); zooming only re-projects them.  Nothing is
+    #looked at until something calls invalidate(), so a sky that isn't
+    #changing costs nothing.  While the clock is running (advancing) every
+    #frame is a new state that won't come back, so none are kept.
+    def __init__(self, engine, resolution=1, size=4, maxBytes=CACHE_BYTES):
+        self.engine = engine
+        self.resolution = resolution
+        self.size = size #number of past states kept
+        self.maxBytes = maxBytes #and their arrays' bytes, at most
+        self.advancing = False
+        self.entries = collections.OrderedDict()
+        self.state = None
+        self.key = None #(state, number of active stars)
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def clear(self):
+        self.entries.clear()
+        self.state = None
+        self.key = None
+        self.dirty = True
+
+    def update(self, observer, shift):
+        #returns True if the engine's positions changed
+        self.dirty = False
+        state = SkyState(observer, self.resolution)
+        key = (state, self.engine.active)
+        if key != self.key:
+            if key in self.entries:
+                self.engine.restore(self.entries.pop(key))
+            else:
+                self.engine.compute(observer)
+            if self.advancing: self.entries.clear()
+            else:
+                self.entries[key] = self.engine.snapshot()
+                self.trim()
+            (self.state, self.key) = (state, key)
+        elif shift == self.engine.shift:
+            return False
+        self.engine.project(shift)
+        return True
+
+    def trim(self):
+        #drops the least recently used states down to size and maxBytes; the
+        #newest shares its arrays with the engine, so it is always kept
+        spare = self.maxBytes
+        for (key, snapshot) in self.entries.items()[:-1]:
+            spare -= sum(array.nbytes for array in snapshot[:5])
+        while len(self.entries) > 1 and (len(self.entries) > self.size or
+                                         spare < 0):
+            (key, snapshot) = self.entries.popitem(last=False)
+            spare += sum(array.nbytes for array in snapshot[:5])
+
+
+def angularDistance(alt1, az1, alt2, az2):
+    cosD = (numpy.sin(alt1)*numpy.sin(alt2) +
+            numpy.cos(alt1)*numpy.cos(alt2)*numpy.cos(az1-az2))
+    return numpy.arccos(numpy.clip(cosD, -1, 1))
+
+def checkAccuracy(bodies, observer, engine=None):
+    #returns the largest alt/az difference (radians) from PyEphem among the
+    #stars that are above the horizon
+    if engine == None: engine = SkyEngine.fromBodies(bodies)
+    engine.compute(observer)
+    (alt, az) = ([ ], [ ])
+    for body in bodies:
+        body.compute(observer)
+        alt.append(float(body.alt))
+        az.append(float(body.az))
+    (alt, az) = (numpy.array(alt), numpy.array(az))
+    above = alt > 0
+    errors = angularDistance(alt, az, engine.alt, engine.az)[above]
+    if len(errors) == 0: return 0.0
+    return float(errors.max())
+
+
+if __name__ == "__main__":
+    #python sky.py [catalog.edb ...]: checks the engine against PyEphem for
+    #a spread of dates and latitudes; exits with 1 if any star above the
+    #horizon is off by more than TOLERANCE
+    import sys
+    import ephem.stars
+    lines = ephem.stars.db.splitlines()
+    for path in sys.argv[1:] or ["ybs.edb"]:
+        with open(path, "rt") as fin: lines.extend(fin.read().splitlines())
+    bodies = [ ]
+    for line in lines:
+        fields = line.strip().split(",")
+        #fixed stars only, as catalog.py reads them
+        if len(fields) < 5 or not fields[1].startswith("f"): continue
+        try:
+            bodies.append(ephem.readdb(line.strip()))
+        except ValueError:
+            continue
+    engine = SkyEngine.fromBodies(bodies)
+    worst = 0
+    for date in ("1900/1/1", "2000/1/1 12:00", "2015/12/10 02:00",
+                 "2050/6/21 22:00", "2100/3/1"):
+        for lat in ("-89:00", "-33:52", "0:00", "40:26", "64:08", "89:00"):
+            observer = ephem.Observer()
+            (observer.lat, observer.long) = (lat, "-79:59")
+            observer.date = ephem.Date(date)
+            error = checkAccuracy(bodies, observer, engine)/ARCSEC
+            worst = max(worst, error)
+            print "%-17s lat %-7s largest difference %6.3f\"" % (date, lat,
+                                                                   error)
+    print "%d stars, largest difference %.3f\" (tolerance %.1f\")" % (
+                                    len(bodies), worst, TOLERANCE/ARCSEC)
+    if worst > TOLERANCE/ARCSEC:
+        print "FAILED"
+        sys.exit(1)
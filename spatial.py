@@ -0,0 +1,177 @@
+from __future__ import division
+
+"""
+Spatial indexes for PyPlanetarium
+
+GridIndex buckets bounding boxes into a uniform grid so finding what is under
+the mouse only looks at the few items sharing its cell instead of every star.
+
+SegmentIndex is the same idea for the lines drawn in draw mode: a line is
+put in just the cells it passes near, so erasing finds the line under the
+mouse without measuring every line.
+
+SkyPartition does the same for the catalog's fixed RA/Dec, kept as sorted
+numpy arrays, so drawing a zoomed-in view only touches the stars in the cells
+the screen overlaps.
+"""
+import math
+import numpy
+
+
+class GridIndex(object):
+    def __init__(self, cellSize=50):
+        self.cellSize = cellSize
+        self.cells = { }
+
+    def __len__(self):
+        return len(self.cells)
+
+    def cellRange(self, left, top, right, bottom):
+        size = self.cellSize
+        return (int(left//size), int(top//size),
+                int(right//size), int(bottom//size))
+
+    def build(self, boxes, pad=1):
+        #boxes = [(item, left, top, right, bottom), ...]
+        #items in each cell keep the order they were given in
+        self.cells = { }
+        for (item, left, top, right, bottom) in boxes:
+            (col0, row0, col1, row1) = self.cellRange(left-pad, top-pad,
+                                                      right+pad, bottom+pad)
+            for row in range(row0, row1+1):
+                for col in range(col0, col1+1):
+                    self.cells.setdefault((row, col), [ ]).append(item)
+
+    def query(self, x, y):
+        #items whose box may contain (x, y)
+        size = self.cellSize
+        return self.cells.get((int(y//size), int(x//size)), [ ])
+
+
+class SegmentIndex(object):
+    #line segments in the cells they pass within pad of; unlike GridIndex
+    #items come and go one at a time
+    def __init__(self, cellSize=50, pad=6):
+        self.cellSize = cellSize
+        self.pad = pad
+        self.cells = { }
+        self.segments = { } #item -> ((x1, y1, x2, y2), cells)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __contains__(self, item):
+        return item in self.segments
+
+    def clear(self):
+        self.cells = { }
+        self.segments = { }
+
+    def cellsAlong(self, x1, y1, x2, y2):
+        #a point within pad of the segment is within pad of the piece of it
+        #in its own row of cells (widened by pad), so each row only needs
+        #the columns under that piece
+        (size, pad) = (self.cellSize, self.pad)
+        cells = [ ]
+        for row in range(int((min(y1, y2)-pad)//size),
+                         int((max(y1, y2)+pad)//size) + 1):
+            if y1 == y2: (low, high) = (min(x1, x2), max(x1, x2))
+            else:
+                (top, bottom) = (row*size - pad, (row+1)*size + pad)
+                t1 = min(1, max(0, (top - y1)/(y2 - y1)))
+                t2 = min(1, max(0, (bottom - y1)/(y2 - y1)))
+                (low, high) = sorted((x1 + t1*(x2-x1), x1 + t2*(x2-x1)))
+            for col in range(int((low-pad)//size), int((high+pad)//size) + 1):
+                cells.append((row, col))
+        return cells
+
+    def add(self, item, x1, y1, x2, y2):
+        if item in self.segments: self.remove(item)
+        cells = self.cellsAlong(x1, y1, x2, y2)
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(item)
+        self.segments[item] = ((x1, y1, x2, y2), cells)
+
+    def remove(self, item):
+        if item not in self.segments: return
+        (points, cells) = self.segments.pop(item)
+        for cell in cells:
+            bucket = self.cells[cell]
+            bucket.discard(item)
+            if len(bucket) == 0: del self.cells[cell]
+
+    def nearest(self, x, y):
+        #the item closest to (x, y), if any is within pad of it
+        size = self.cellSize
+        (best, bestDistance) = (None, self.pad**2)
+        for item in self.cells.get((int(y//size), int(x//size)), ()):
+            distance = segmentDistance2(x, y, *self.segments[item][0])
+            if distance <= bestDistance: (best, bestDistance) = (item, distance)
+        return best
+
+
+def segmentDistance2(x, y, x1, y1, x2, y2):
+    #squared distance from (x, y) to the segment (x1, y1)-(x2, y2)
+    (dx, dy) = (x2 - x1, y2 - y1)
+    length2 = dx*dx + dy*dy
+    t = 0
+    if length2 > 0: t = min(1, max(0, ((x - x1)*dx + (y - y1)*dy)/length2))
+    (nearX, nearY) = (x1 + t*dx, y1 + t*dy)
+    return (x - nearX)**2 + (y - nearY)**2
+
+
+class SkyPartition(object):
+    #stars bucketed by J2000 RA/Dec into bands x sectors cells, so the
+    #buckets never change as the sky turns; order holds star indices sorted
+    #by cell and starts[cell] is where each cell begins in it
+    def __init__(self, bands=90, sectors=180):
+        (self.bands, self.sectors) = (bands, sectors)
+        self.order = numpy.zeros(0, dtype=int)
+        self.starts = numpy.zeros(bands*sectors + 1, dtype=int)
+        self.built = False
+
+    def bandOf(self, dec):
+        band = numpy.floor((numpy.asarray(dec) + math.pi/2)/math.pi*self.bands)
+        return numpy.clip(band, 0, self.bands-1).astype(int)
+
+    def sectorOf(self, ra):
+        sector = numpy.floor(numpy.asarray(ra)/(2*math.pi)*self.sectors)
+        return numpy.clip(sector, 0, self.sectors-1).astype(int)
+
+    def build(self, ra, dec):
+        #J2000 ra and dec of every star, in radians
+        ids = self.bandOf(dec)*self.sectors + self.sectorOf(ra % (2*math.pi))
+        self.order = numpy.argsort(ids) #query() sorts what it returns
+        self.starts = numpy.searchsorted(ids[self.order],
+                                numpy.arange(self.bands*self.sectors + 1))
+        self.built = True
+
+    def sectorRanges(self, ra, dec, radius):
+        #(first, last) sectors within radius of (ra, dec), wrapping at 0h
+        if abs(dec) + radius >= math.pi/2: #reaches over a pole
+            return [(0, self.sectors-1)]
+        spread = math.asin(min(1, math.sin(radius)/math.cos(dec)))
+        first = int(self.sectorOf((ra - spread) % (2*math.pi)))
+        last = int(self.sectorOf((ra + spread) % (2*math.pi)))
+        if first <= last: return [(first, last)]
+        return [(0, last), (first, self.sectors-1)]
+
+    def query(self, center, radius):
+        #star indices, ascending, in the cells touching the cap of angular
+        #radius around the J2000 unit vector center
+        (x, y, z) = center
+        dec = math.asin(max(-1, min(1, z)))
+        ra = math.atan2(y, x) % (2*math.pi)
+        band0 = int(self.bandOf(max(-math.pi/2, dec - radius)))
+        band1 = int(self.bandOf(min(math.pi/2, dec + radius)))
+        pieces = [ ]
+        for (first, last) in self.sectorRanges(ra, dec, radius):
+            for band in range(band0, band1+1):
+                #sectors of one band are next to each other in order
+                start = self.starts[band*self.sectors + first]
+                end = self.starts[band*self.sectors + last + 1]
+                pieces.append(self.order[start:end])
+        if len(pieces) == 0: return numpy.zeros(0, dtype=int)
+        stars = numpy.concatenate(pieces)
+        stars.sort()
+        return stars